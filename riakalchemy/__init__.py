@@ -17,7 +17,9 @@
 
     Pull relevant stuff into the riakalchemy.* namespace
 """
+import memory
 import model
+import sessions
 from model import NoSuchObjectError
 
 global RiakObject
@@ -30,5 +32,15 @@ def use_real_backend():
     RiakObject = model.RiakObject
     connect = model.connect
 
+
+def use_memory_backend():
+    """Keep everything in this process instead of talking to Riak.
+    connect() then starts out with an empty store."""
+    global RiakObject
+    global connect
+    RiakObject = model.RiakObject
+    connect = memory.connect
+
 reset_registry = model.reset_registry
+session = sessions.session
 use_real_backend()
@@ -0,0 +1,197 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Benchmarks for the mapper's own overhead
+
+    Runs against riakalchemy.memory, so no Riak is needed. Results are
+    printed as JSON:
+
+        $ python -m riakalchemy.benchmarks --number 200 --latency 0.0005
+"""
+import json
+import optparse
+import sys
+import time
+
+from riakalchemy import model
+from riakalchemy.memory import MemoryClient
+from riakalchemy.types import Dict, Integer, RelatedObjects, String
+
+
+class BenchPerson(model.RiakObject):
+    bucket_name = 'bench_people'
+
+    first_name = String(required=True)
+    last_name = String()
+    email = String()
+    city = String(index=True)
+    age = Integer(index=True)
+    profile = Dict()
+    friends = RelatedObjects(backref=True)
+
+
+def _profile(i):
+    # Roughly 2 KB of JSON
+    return {'bio': 'x' * 1024,
+            'tags': ['tag%d' % (n,) for n in range(50)],
+            'settings': dict(('setting%d' % (n,), n * i) for n in range(30))}
+
+
+def _person(i, friends=()):
+    return BenchPerson(first_name='first%d' % (i,),
+                       last_name='last%d' % (i % 100,),
+                       email='person%d@example.com' % (i,),
+                       city='city%d' % (i % 10,),
+                       age=20 + i % 50,
+                       profile=_profile(i),
+                       friends=list(friends))
+
+
+class Benchmarks(object):
+    def __init__(self, client, number, links):
+        self.client = client
+        self.number = number
+        self.links = links
+
+    def setup(self):
+        self.friends = [_person(i) for i in range(self.links)]
+        for friend in self.friends:
+            friend.save()
+        self.people = [_person(i, self.friends) for i in range(self.number)]
+        for person in self.people:
+            person.save()
+        self.keys = [person.key for person in self.people]
+        self.riak_objs = [self.client.bucket(BenchPerson.bucket_name).get(k)
+                          for k in self.keys]
+
+    def bench_save_new(self, i):
+        _person(i).save()
+
+    def bench_save_unchanged(self, i):
+        self.people[i].save()
+
+    def bench_save_changed(self, i):
+        person = self.people[i]
+        person.age += 1
+        person.save()
+
+    def bench_get(self, i):
+        BenchPerson.get(self.keys[i])
+
+    def bench_load(self, i):
+        BenchPerson.load(self.riak_objs[i])
+
+    def bench_clean(self, i):
+        self.people[i].clean()
+
+    def bench_json(self, i):
+        # json() cannot serialize related objects, so use objects
+        # without any
+        self.friends[i % self.links].json()
+
+    def bench_relation_traversal(self, i):
+        BenchPerson.get(self.keys[i]).friends
+
+    def bench_query_2i_all(self, i):
+        BenchPerson.get(city='city%d' % (i % 10,)).all()
+
+    def bench_query_2i_iter(self, i):
+        list(BenchPerson.get(city='city%d' % (i % 10,)))
+
+    def bench_query_backref(self, i):
+        BenchPerson.get(friends=self.friends[i % self.links]).first()
+
+    def bench_query_mapreduce(self, i):
+        BenchPerson.get_mr(last_name='last%d' % (i % 100,)).all()
+
+    def bench_query_projected(self, i):
+        BenchPerson.get_mr(last_name='last%d' % (i % 100,)).only(
+            'first_name').all()
+
+    def bench_query_search(self, i):
+        BenchPerson.get_search(last_name='last%d' % (i % 100,)).all()
+
+    def bench_query_search_docs(self, i):
+        BenchPerson.get_search(last_name='last%d' % (i % 100,)).only(
+            'first_name', 'age').all()
+
+    def names(self):
+        return sorted(name[len('bench_'):] for name in dir(self)
+                                            if name.startswith('bench_'))
+
+    def run(self, name, repeat):
+        func = getattr(self, 'bench_' + name)
+        # Query benchmarks scan the whole bucket, keep them shorter
+        number = self.number
+        if name.startswith('query_'):
+            number = max(1, number // 10)
+        timings = []
+        round_trips = self.client.round_trips
+        for i in range(repeat):
+            start = time.time()
+            for n in range(number):
+                func(n)
+            timings += [(time.time() - start) / number]
+        round_trips = self.client.round_trips - round_trips
+        return {'name': name,
+                'calls': number * repeat,
+                'best_us': min(timings) * 1e6,
+                'mean_us': sum(timings) / len(timings) * 1e6,
+                'round_trips_per_call': float(round_trips) /
+                                        (number * repeat)}
+
+
+def run(number=100, repeat=3, latency=0, links=20, only=None):
+    """Run the benchmarks and return a list of result dicts."""
+    old_client = model.client
+    model.client = client = MemoryClient(latency=latency)
+    try:
+        benchmarks = Benchmarks(client, number, links)
+        benchmarks.setup()
+        names = only or benchmarks.names()
+        return [benchmarks.run(name, repeat) for name in names]
+    finally:
+        model.client = old_client
+
+
+def main(argv=None):
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--number', type='int', default=100,
+                      help='objects (and calls) per benchmark')
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    parser.add_option('-l', '--latency', type='float', default=0,
+                      help='simulated seconds per round trip')
+    parser.add_option('--links', type='int', default=20,
+                      help='related objects per object')
+    parser.add_option('-o', '--output', help='write results to this file')
+    options, args = parser.parse_args(argv)
+
+    results = {'number': options.number,
+               'latency': options.latency,
+               'links': options.links,
+               'results': run(options.number, options.repeat,
+                              options.latency, options.links, args or None)}
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Read-through caches for RiakObject.get(key)
+
+    A cache is anything with get(key), set(key, value), delete(key)
+    and stats() methods. Set one as the `cache` attribute of a model
+    to enable it.
+"""
+import copy
+import cPickle as pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """In-process cache holding at most `max_size` entries, each for at
+    most `ttl` seconds (forever if `ttl` is None)."""
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return None
+            # Move it to the back of the line
+            self._entries[key] = (expires, value)
+            self.hits += 1
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries)}
+
+
+class MemcacheCache(object):
+    """Cache backed by a memcached-style client (anything with get, set
+    and delete methods, such as python-memcached's Client), so that
+    several processes can share it. Evictions happen inside memcached
+    and are not counted here."""
+
+    def __init__(self, client, ttl=0, prefix='riakalchemy:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key,
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': None}
@@ -0,0 +1,178 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Serialization codecs
+
+    A codec turns a model's data into the payload stored in Riak and
+    back. The codec's content type is stored on every object it writes,
+    and one codec per content type is registered as decoder with the
+    Riak clients, so any model can read objects written with any codec
+    (including plain JSON objects written before codecs existed).
+    Codecs of the same content type read each other's payloads, so only
+    codecs with a new content type need to be passed to register().
+
+    Set `codec` on a model, or replace `default_codec` to change it
+    everywhere. Codecs can also compress large dict values (i.e. Dict
+    fields). Such values are stored as {"__zlib__": <compressed value>},
+    which leaves the rest of the object readable for MapReduce and
+    Search.
+"""
+import base64
+import json
+import zlib
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Codecs by content type
+_codecs = {}
+# Bumped on every register(), so clients know to pick up new codecs
+version = 0
+
+
+def register(codec):
+    """Use `codec` to read and write `codec.content_type` payloads,
+    replacing the codec registered for it before."""
+    global version
+    _codecs[codec.content_type] = codec
+    version += 1
+
+
+def get(content_type):
+    return _codecs.get(content_type)
+
+
+def install(client):
+    """Register all codecs as encoders and decoders with `client`."""
+    for content_type, codec in _codecs.items():
+        client.set_encoder(content_type, codec.encode)
+        client.set_decoder(content_type, codec.decode)
+
+
+class Codec(object):
+    content_type = None
+    compress_marker = '__zlib__'
+
+    def __init__(self, compress_threshold=None, compress_level=6):
+        """Dict values that take up more than `compress_threshold` bytes
+        once encoded are compressed. None turns compression off."""
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, payload):
+        raise NotImplementedError()
+
+    def _pack(self, compressed):
+        return compressed
+
+    def _unpack(self, packed):
+        return packed
+
+    def _compress(self, value):
+        if not isinstance(value, dict):
+            return value
+        encoded = self.dumps(value)
+        if len(encoded) <= self.compress_threshold:
+            return value
+        compressed = zlib.compress(encoded, self.compress_level)
+        return {self.compress_marker: self._pack(compressed)}
+
+    def encode(self, data):
+        if self.compress_threshold is not None and isinstance(data, dict):
+            data = dict((k, self._compress(v)) for k, v in data.iteritems())
+        return self.dumps(data)
+
+    def decode(self, payload):
+        data = self.loads(payload)
+        if self.compress_marker in payload and isinstance(data, dict):
+            for k, v in data.items():
+                data[k] = self.expand(v)
+        return data
+
+    def expand(self, value):
+        """Decompress `value` if it is a compressed dict value."""
+        if (isinstance(value, dict) and len(value) == 1 and
+                self.compress_marker in value):
+            packed = value[self.compress_marker]
+            return self.loads(zlib.decompress(self._unpack(packed)))
+        return value
+
+
+class JSONCodec(Codec):
+    """JSON. With `fast`, ujson is used instead of the json module.
+    It is quicker, but keeps at most 15 significant digits of floats,
+    so some float values don't come back exactly as they were saved."""
+    content_type = 'application/json'
+
+    def __init__(self, compress_threshold=None, compress_level=6,
+                 fast=False):
+        if fast and ujson is None:
+            raise ImportError('JSONCodec(fast=True) needs the ujson '
+                              'package')
+        super(JSONCodec, self).__init__(compress_threshold, compress_level)
+        self.fast = fast
+
+    def dumps(self, value):
+        if self.fast:
+            # ujson's most precise setting
+            return ujson.dumps(value, double_precision=15)
+        return json.dumps(value)
+
+    def loads(self, payload):
+        if self.fast:
+            return ujson.loads(payload, precise_float=True)
+        return json.loads(payload)
+
+    def _pack(self, compressed):
+        return base64.b64encode(compressed)
+
+    def _unpack(self, packed):
+        return base64.b64decode(packed)
+
+
+class MsgpackCodec(Codec):
+    """MessagePack. Note that Riak's MapReduce and Search only
+    understand JSON, so only use it for models that are looked up by
+    key or secondary index."""
+    content_type = 'application/x-msgpack'
+
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise ImportError('MsgpackCodec needs the msgpack package')
+        super(MsgpackCodec, self).__init__(*args, **kwargs)
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+default_codec = JSONCodec()
+register(default_codec)
+if msgpack is not None:
+    register(MsgpackCodec())
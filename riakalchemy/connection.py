@@ -0,0 +1,169 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Connection management: one persistent client per thread, spread
+    across a set of Riak nodes
+"""
+import threading
+import time
+import weakref
+
+from riakalchemy import codecs
+
+PROTOCOLS = {'http': 'http', 'pb': 'pbc', 'pbc': 'pbc'}
+
+
+class RiakNode(object):
+    def __init__(self, host='127.0.0.1', http_port=8098, pb_port=8087):
+        self.host = host
+        self.http_port = http_port
+        self.pb_port = pb_port
+        self.threads = 0
+        self.ejected_until = 0
+        self.last_checked = 0
+
+    @classmethod
+    def from_config(cls, node):
+        if isinstance(node, RiakNode):
+            return node
+        if isinstance(node, basestring):
+            return cls(host=node)
+        if isinstance(node, dict):
+            return cls(**node)
+        return cls(*node)
+
+    def is_ejected(self):
+        return self.ejected_until > time.time()
+
+    def __repr__(self):
+        return '<RiakNode %s:%s/%s>' % (self.host, self.http_port,
+                                        self.pb_port)
+
+
+class ConnectionPool(object):
+    """Hands every thread its own client, bound to one of `nodes`.
+
+    Clients are kept for the lifetime of the thread so their
+    connections stay open. New threads are assigned a node either
+    round-robin or to the node serving the fewest threads. Every
+    `check_interval` seconds the node in use is pinged; a node that
+    fails is ejected for `eject_for` seconds and its threads move to
+    another node."""
+
+    def __init__(self, nodes, protocol='http', strategy='round_robin',
+                 check_interval=5, eject_for=30):
+        if protocol not in PROTOCOLS:
+            raise ValueError('Unknown protocol: %s' % (protocol,))
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError('Unknown node selection strategy: %s' %
+                             (strategy,))
+        self.nodes = [RiakNode.from_config(node) for node in nodes]
+        self.protocol = PROTOCOLS[protocol]
+        self.strategy = strategy
+        self.check_interval = check_interval
+        self.eject_for = eject_for
+        self._next = -1
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_refs = set()
+
+    def _choose_node(self):
+        nodes = [node for node in self.nodes if not node.is_ejected()]
+        if not nodes:
+            # Everything is down. Pick the node that has been out the
+            # longest and hope for the best.
+            nodes = [min(self.nodes, key=lambda node: node.ejected_until)]
+        if self.strategy == 'least_loaded':
+            return min(nodes, key=lambda node: node.threads)
+        self._next += 1
+        return nodes[self._next % len(nodes)]
+
+    def _new_client(self, node):
+        import riak
+        return riak.RiakClient(protocol=self.protocol, host=node.host,
+                               http_port=node.http_port,
+                               pb_port=node.pb_port)
+
+    def _bind(self):
+        with self._lock:
+            old_node = getattr(self._local, 'node', None)
+            if old_node:
+                old_node.threads -= 1
+            node = self._choose_node()
+            node.threads += 1
+            if not old_node:
+                # Give the thread's slot back once the thread is gone
+                def release(ref, pool=self):
+                    with pool._lock:
+                        pool._thread_refs.discard(ref)
+                        node_ref[0].threads -= 1
+                node_ref = [node]
+                self._local.node_ref = node_ref
+                self._thread_refs.add(
+                    weakref.ref(threading.current_thread(), release))
+            else:
+                self._local.node_ref[0] = node
+        self._local.node = node
+        self._local.client = self._new_client(node)
+        self._local.codecs_version = None
+
+    def _is_alive(self, client):
+        try:
+            if hasattr(client, 'ping'):
+                return client.ping()
+            return client.is_alive()
+        except Exception:
+            return False
+
+    def _check(self, node, client):
+        now = time.time()
+        if now - node.last_checked < self.check_interval:
+            return True
+        with self._lock:
+            if now - node.last_checked < self.check_interval:
+                return True
+            node.last_checked = now
+        if self._is_alive(client):
+            return True
+        self.eject(node)
+        return False
+
+    def eject(self, node):
+        node.ejected_until = time.time() + self.eject_for
+
+    def client(self):
+        node = getattr(self._local, 'node', None)
+        if node is None or node.is_ejected():
+            self._bind()
+        if (not self._check(self._local.node, self._local.client) and
+                len(self.nodes) > 1):
+            self._bind()
+        if self._local.codecs_version != codecs.version:
+            codecs.install(self._local.client)
+            self._local.codecs_version = codecs.version
+        return self._local.client
+
+
+class PooledClient(object):
+    """Stands in for a RiakClient, forwarding everything to the calling
+    thread's client from `pool`."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.pool.client(), name)
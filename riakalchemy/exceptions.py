@@ -28,3 +28,25 @@ class ValidationError(RiakAlchemyError):
 
 class NoSuchObjectError(RiakAlchemyError):
     pass
+
+
+class DuplicateBucketError(RiakAlchemyError):
+    pass
+
+
+class BufferFullError(RiakAlchemyError):
+    pass
+
+
+class TimeoutError(RiakAlchemyError):
+    """A Future wasn't done in time."""
+
+
+class FlushError(RiakAlchemyError):
+    """Some objects could not be saved when a session was flushed.
+    `failed` holds (object, exception) pairs."""
+
+    def __init__(self, failed):
+        super(FlushError, self).__init__('%d object(s) failed to save' %
+                                         (len(failed),))
+        self.failed = failed
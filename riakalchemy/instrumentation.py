@@ -0,0 +1,218 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Instrumentation
+
+    Once enable()d, every instrumented operation (get, save, delete,
+    load, clean, encode, store, query, traverse, ...) produces an Event
+    carrying the model and bucket it was about, how long it took, and
+    how many requests to Riak it made, nested operations included. So an
+    N+1 relation traversal shows up as a 'traverse' with a high
+    round trip count. Events go to the sinks passed to enable(); by
+    default to `stats`, which keeps counters and latency histograms
+    in-process:
+
+        from riakalchemy import instrumentation
+        instrumentation.enable()
+        ...
+        print(instrumentation.snapshot())
+
+    When disabled, instrumented calls cost one extra function call.
+"""
+import collections
+import functools
+import logging
+import re
+import socket
+import threading
+import time
+
+Event = collections.namedtuple('Event', 'operation model bucket duration '
+                                        'round_trips error')
+
+enabled = False
+sinks = []
+_local = threading.local()
+
+
+def enable(*new_sinks):
+    """Start sending events to `new_sinks` (default: `stats`)."""
+    global enabled
+    sinks[:] = list(new_sinks) or [stats]
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+    sinks[:] = []
+
+
+def snapshot():
+    return stats.snapshot()
+
+
+def _calls():
+    try:
+        return _local.calls
+    except AttributeError:
+        _local.calls = []
+        return _local.calls
+
+
+def round_trip(n=1):
+    """Count `n` requests to Riak against the operations in progress."""
+    if not enabled:
+        return
+    for call in _calls():
+        call[0] += n
+
+
+def _model_of(obj):
+    if isinstance(obj, type):
+        return obj
+    # Queries know their model
+    return getattr(obj, 'cls', type(obj))
+
+
+def instrumented(operation):
+    """Decorator for methods (and classmethods, put it below the
+    @classmethod) whose calls should produce events."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            if not enabled:
+                return func(obj, *args, **kwargs)
+
+            calls = _calls()
+            call = [0]
+            calls.append(call)
+            error = False
+            start = time.time()
+            try:
+                return func(obj, *args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                duration = time.time() - start
+                calls.pop()
+                model = _model_of(obj)
+                emit(Event(operation, model.__name__,
+                           getattr(model, 'bucket_name', None),
+                           duration, call[0], error))
+        return wrapper
+    return decorator
+
+
+def emit(event):
+    for sink in sinks:
+        sink.record(event)
+
+
+class Stats(object):
+    """Keeps count, errors, latency histogram and round trips per
+    (operation, model, bucket)."""
+
+    # Upper bounds of the latency histogram buckets, in milliseconds
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def record(self, event):
+        ms = event.duration * 1000
+        label = (event.operation, event.model, event.bucket)
+        with self._lock:
+            stat = self._stats.get(label)
+            if stat is None:
+                stat = self._stats[label] = {
+                    'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'round_trips': 0, 'max_round_trips': 0,
+                    'histogram': [0] * (len(self.buckets) + 1)}
+            stat['count'] += 1
+            stat['errors'] += event.error
+            stat['total_ms'] += ms
+            stat['max_ms'] = max(stat['max_ms'], ms)
+            stat['round_trips'] += event.round_trips
+            stat['max_round_trips'] = max(stat['max_round_trips'],
+                                          event.round_trips)
+            for i, bound in enumerate(self.buckets):
+                if ms <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            stat['histogram'][i] += 1
+
+    def snapshot(self):
+        """Return {(operation, model, bucket): stats}. The histogram is
+        a dict mapping the upper bound of each bucket (in ms, None for
+        the last one) to the number of calls."""
+        bounds = list(self.buckets) + [None]
+        with self._lock:
+            retval = {}
+            for label, stat in self._stats.iteritems():
+                stat = dict(stat)
+                stat['histogram'] = dict(zip(bounds, stat['histogram']))
+                retval[label] = stat
+            return retval
+
+
+class LoggingSink(object):
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('riakalchemy')
+        self.level = level
+
+    def record(self, event):
+        self.logger.log(self.level, '%s %s (%s): %.2f ms, %d round trips%s',
+                        event.operation, event.model, event.bucket,
+                        event.duration * 1000, event.round_trips,
+                        event.error and ', failed' or '')
+
+
+class StatsdSink(object):
+    """Sends timers and counters to statsd over UDP, named
+    <prefix>.<bucket>.<operation>."""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='riakalchemy'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, event):
+        name = '%s.%s.%s' % (self.prefix, event.bucket or event.model,
+                             event.operation)
+        return re.sub(r'[^\w.-]', '_', name)
+
+    def record(self, event):
+        name = self._name(event)
+        lines = ['%s:%.3f|ms' % (name, event.duration * 1000),
+                 '%s.round_trips:%d|h' % (name, event.round_trips)]
+        if event.error:
+            lines += ['%s.errors:1|c' % (name,)]
+        try:
+            self._socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+
+stats = Stats()
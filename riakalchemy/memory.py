@@ -0,0 +1,606 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    In-memory Riak backend
+
+    MemoryClient implements the parts of the riak client API that
+    RiakAlchemy uses: buckets and their properties, keys, objects with
+    links and secondary indexes, exact, range and paginated 2i queries,
+    search queries (as MapReduce inputs and through the Solr interface)
+    and the MapReduce queries built by RiakAlchemy itself. Deletes
+    take effect immediately, like Riak with delete_mode set to
+    immediate. Every request can be given an artificial delay to
+    simulate network round trips.
+
+    Switch to it with riakalchemy.use_memory_backend().
+"""
+import binascii
+import json
+import os
+import re
+import threading
+import time
+
+from riakalchemy import codecs
+from riakalchemy import model
+from riakalchemy import workers
+from riakalchemy.model import MapReducePlan, _index_value
+
+
+class MemoryRecord(object):
+    def __init__(self, encoded_data, content_type, links, indexes, vclock):
+        self.encoded_data = encoded_data
+        self.content_type = content_type
+        self.links = links
+        self.indexes = indexes
+        self.vclock = vclock
+        self.last_modified = time.time()
+
+
+class MemoryRiakObject(object):
+    def __init__(self, bucket, key=None, data=None):
+        self.bucket = bucket
+        self.key = key
+        self._data = data
+        self._encoded_data = None
+        self.content_type = 'application/json'
+        self.links = []
+        self.indexes = set()
+        self.vclock = None
+        self.last_modified = None
+        self.exists = False
+
+    # Like in the riak client, data is decoded from encoded_data (and
+    # the other way around) on first access
+    def _get_data(self):
+        if self._encoded_data is not None and self._data is None:
+            decoder = self.bucket.client.get_decoder(self.content_type)
+            self._data = decoder(self._encoded_data)
+            self._encoded_data = None
+        return self._data
+
+    def _set_data(self, value):
+        self._encoded_data = None
+        self._data = value
+
+    data = property(_get_data, _set_data)
+
+    def _get_encoded_data(self):
+        if self._data is not None and self._encoded_data is None:
+            encoder = self.bucket.client.get_encoder(self.content_type)
+            self._encoded_data = encoder(self._data)
+            self._data = None
+        return self._encoded_data
+
+    def _set_encoded_data(self, value):
+        self._data = None
+        self._encoded_data = value
+
+    encoded_data = property(_get_encoded_data, _set_encoded_data)
+
+    def add_index(self, field, value):
+        self.indexes.add((field, value))
+        return self
+
+    def remove_index(self, field=None, value=None):
+        self.indexes = set((f, v) for (f, v) in self.indexes
+                                  if not ((field is None or f == field) and
+                                          (value is None or v == value)))
+        return self
+
+    # Quorum options are accepted (and ignored) with the same
+    # signatures as the riak client's
+
+    def store(self, w=None, dw=None, pw=None, return_body=True,
+              if_none_match=False, timeout=None):
+        self.bucket.client.put(self)
+        return self
+
+    def delete(self, rw=None, r=None, w=None, dw=None, pr=None, pw=None,
+               timeout=None):
+        self.bucket.client.delete(self)
+        return self.clear()
+
+    def clear(self):
+        self.exists = False
+        self.data = None
+        self.links = []
+        self.indexes = set()
+        return self
+
+
+class MemoryBucket(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def new(self, key=None, data=None):
+        return MemoryRiakObject(self, key, data)
+
+    def get(self, key, r=None, pr=None, timeout=None):
+        return self.client._get(self, key)
+
+    def set_properties(self, props):
+        self.client._round_trip()
+        self.client._properties.setdefault(self.name, {}).update(props)
+
+    def get_properties(self):
+        self.client._round_trip()
+        return dict(self.client._properties.get(self.name, {}))
+
+    def get_property(self, name):
+        return self.get_properties().get(name)
+
+    def enable_search(self):
+        self.set_properties({'search': True})
+
+    def search_enabled(self):
+        return bool(self.get_property('search'))
+
+    def get_keys(self):
+        self.client._round_trip()
+        return [key for bucket, key in self.client._keys(self.name)]
+
+    def stream_keys(self):
+        yield self.get_keys()
+
+    def get_index(self, index, startkey, endkey=None, return_terms=None,
+                  max_results=None, continuation=None):
+        self.client._round_trip()
+        keys = [key for bucket, key in
+                self.client._index_keys(self.name, index, startkey, endkey)]
+        start = int(continuation or 0)
+        if max_results:
+            end = start + max_results
+        else:
+            end = len(keys)
+        page = MemoryIndexPage(keys[start:end])
+        if end < len(keys):
+            page.continuation = str(end)
+        return page
+
+    def stream_index(self, index, startkey, endkey=None, return_terms=None,
+                     max_results=None, continuation=None):
+        yield self.get_index(index, startkey, endkey,
+                             max_results=max_results,
+                             continuation=continuation).results
+
+
+class MemoryIndexPage(object):
+    continuation = None
+
+    def __init__(self, results):
+        self.results = results
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+
+class MemoryQuery(object):
+    """A MapReduce job: some inputs and a list of phases."""
+
+    def __init__(self, client, inputs):
+        self.client = client
+        self.inputs = inputs
+        self.phases = []
+
+    def map(self, function, options=None):
+        self.phases += [('map', function, (options or {}).get('arg'))]
+        return self
+
+    def reduce(self, function, options=None):
+        self.phases += [('reduce', function, (options or {}).get('arg'))]
+        return self
+
+    def run(self, timeout=None):
+        self.client._round_trip()
+        results = [[bucket, key] for bucket, key in self.inputs()]
+        for kind, function, arg in self.phases:
+            if kind == 'map':
+                results = sum([self.client._map(function, arg, result)
+                               for result in results], [])
+            else:
+                results = self.client._reduce(function, arg, results)
+        return results
+
+
+def js_equal(a, b):
+    """Approximates JavaScript's == for the JSON values we compare."""
+    if isinstance(a, basestring) != isinstance(b, basestring):
+        try:
+            return float(a) == float(b)
+        except (TypeError, ValueError):
+            return False
+    return a == b
+
+
+def search_order(value):
+    """Sort key for search values: numbers by value, before strings."""
+    try:
+        return (0, float(value))
+    except (TypeError, ValueError):
+        return (1, value)
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _wildcard(pattern):
+    """Compile a search term with * and ? wildcards (and backslash
+    escapes) into a regex."""
+    regex = ''
+    for escaped, char in re.findall(r'\\(.)|(.)', pattern, re.S):
+        if char == '*':
+            regex += '.*'
+        elif char == '?':
+            regex += '.'
+        else:
+            regex += re.escape(escaped or char)
+    return re.compile(regex + r'\Z', re.S)
+
+
+class SearchQuery(object):
+    """Parses the subset of the Riak Search query syntax RiakAlchemy
+    uses: field:value and field:"quoted value" terms (with * and ?
+    wildcards and backslash escapes), [a TO b] and {a TO b} ranges (*
+    leaves an end open), AND, OR, NOT and parentheses. Terms next to
+    each other are ANDed."""
+
+    _token = re.compile(r'\s*(?:(AND|OR|NOT)\b|(\()|(\))|'
+                        r'(\w+):("(?:[^"\\]|\\.)*"|'
+                        r'[\[{](?:[^\]}\\]|\\.)*[\]}]|'
+                        r'(?:[^\s()\\]|\\.)+))')
+
+    def __init__(self, query):
+        self.tokens = []
+        pos = 0
+        query = query.strip()
+        while pos < len(query):
+            match = self._token.match(query, pos)
+            if not match:
+                raise ValueError('Cannot parse search query at %r' %
+                                 (query[pos:],))
+            self.tokens += [match.groups()]
+            pos = match.end()
+            while pos < len(query) and query[pos].isspace():
+                pos += 1
+        self.pos = 0
+        self.matches = self._parse_or()
+        if self.pos != len(self.tokens):
+            raise ValueError('Unexpected tokens in search query: %r' %
+                             (query,))
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None, None, None, None)
+
+    def _parse_or(self):
+        terms = [self._parse_and()]
+        while self._peek()[0] == 'OR':
+            self.pos += 1
+            terms += [self._parse_and()]
+        return lambda data: any(term(data) for term in terms)
+
+    def _parse_and(self):
+        terms = [self._parse_not()]
+        while True:
+            op, lparen, rparen, field, value = self._peek()
+            if op == 'AND':
+                self.pos += 1
+            elif not (op == 'NOT' or lparen or field):
+                break
+            terms += [self._parse_not()]
+        return lambda data: all(term(data) for term in terms)
+
+    def _parse_not(self):
+        if self._peek()[0] == 'NOT':
+            self.pos += 1
+            term = self._parse_not()
+            return lambda data: not term(data)
+        return self._parse_term()
+
+    def _parse_term(self):
+        op, lparen, rparen, field, value = self._peek()
+        self.pos += 1
+        if lparen:
+            expr = self._parse_or()
+            if not self._peek()[2]:
+                raise ValueError('Missing ) in search query')
+            self.pos += 1
+            return expr
+        if not field:
+            raise ValueError('Expected a search term')
+        return self._term(field, value)
+
+    def _term(self, field, value):
+        if value.startswith('"'):
+            value = _unescape(value[1:-1])
+            return lambda data: (field in data and
+                                 js_equal(data[field], value))
+        if value[0] in '[{':
+            return self._range(field, value)
+
+        pattern = _wildcard(value)
+
+        def matches(data):
+            if field not in data:
+                return False
+            if isinstance(data[field], basestring):
+                field_value = data[field]
+            else:
+                field_value = json.dumps(data[field])
+            return pattern.match(field_value) is not None
+        return matches
+
+    def _range(self, field, value):
+        ends = re.split(r'(?<!\\) TO ', value[1:-1].strip())
+        if len(ends) != 2:
+            raise ValueError('Cannot parse search range %r' % (value,))
+        low, high = [end != '*' and search_order(_unescape(end)) or None
+                     for end in ends]
+        inclusive = (value[0] == '[', value[-1] == ']')
+
+        def matches(data):
+            if data.get(field) is None or isinstance(data[field],
+                                                     (dict, list)):
+                return False
+            order = search_order(data[field])
+            if low is not None and (order < low or
+                                    (order == low and not inclusive[0])):
+                return False
+            if high is not None and (order > high or
+                                     (order == high and not inclusive[1])):
+                return False
+            return True
+        return matches
+
+
+class MemoryClient(object):
+    """Keeps everything in a dict. `latency` is the number of seconds
+    every request to "Riak" takes."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.round_trips = 0
+        self._buckets = {}
+        self._properties = {}
+        self._encoders = {}
+        self._decoders = {}
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _records(self, bucket_name):
+        return self._buckets.setdefault(bucket_name, {})
+
+    def bucket(self, name):
+        return MemoryBucket(self, name)
+
+    def put(self, robj, w=None, dw=None, pw=None, return_body=True,
+            if_none_match=False, timeout=None):
+        self._store(robj)
+
+    def delete(self, robj, rw=None, r=None, w=None, dw=None, pr=None,
+               pw=None, timeout=None):
+        self._delete(robj.bucket.name, robj.key)
+
+    def set_encoder(self, content_type, encoder):
+        self._encoders[content_type] = encoder
+
+    def get_encoder(self, content_type):
+        if content_type in self._encoders:
+            return self._encoders[content_type]
+        return codecs.get(content_type).encode
+
+    def set_decoder(self, content_type, decoder):
+        self._decoders[content_type] = decoder
+
+    def get_decoder(self, content_type):
+        if content_type in self._decoders:
+            return self._decoders[content_type]
+        return codecs.get(content_type).decode
+
+    def _decode(self, record):
+        return self.get_decoder(record.content_type)(record.encoded_data)
+
+    def ping(self):
+        return True
+
+    def _get(self, bucket, key):
+        self._round_trip()
+        obj = MemoryRiakObject(bucket, key)
+        record = self._records(bucket.name).get(key)
+        if record is not None:
+            obj.content_type = record.content_type
+            obj.encoded_data = record.encoded_data
+            obj.links = list(record.links)
+            obj.indexes = set(record.indexes)
+            obj.vclock = record.vclock
+            obj.last_modified = record.last_modified
+            obj.exists = True
+        return obj
+
+    def _store(self, obj):
+        self._round_trip()
+        with self._lock:
+            if obj.key is None:
+                # Like uuid4().hex, without the slow uuid import
+                obj.key = binascii.hexlify(os.urandom(16))
+            records = self._records(obj.bucket.name)
+            old = records.get(obj.key)
+            vclock = (old and old.vclock or 0) + 1
+            record = MemoryRecord(obj.encoded_data, obj.content_type,
+                                  [tuple(link) for link in obj.links],
+                                  set(obj.indexes), vclock)
+            records[obj.key] = record
+        obj.vclock = record.vclock
+        obj.last_modified = record.last_modified
+        obj.exists = True
+
+    def _delete(self, bucket_name, key):
+        self._round_trip()
+        with self._lock:
+            self._records(bucket_name).pop(key, None)
+
+    def _keys(self, bucket_name):
+        return [(bucket_name, key)
+                for key in sorted(self._records(bucket_name).keys())]
+
+    def _map(self, function, arg, result):
+        bucket_name, key = result[0], result[1]
+        record = self._records(bucket_name).get(key)
+        if record is None:
+            return []
+        data = self._decode(record) or {}
+        if function == MapReducePlan.project_source:
+            return [[key, dict((field, data[field]) for field in arg
+                                                    if field in data)]]
+        elif function == MapReducePlan.count_source:
+            return [1]
+        elif function == MapReducePlan.value_source:
+            if arg in data:
+                return [data[arg]]
+            return []
+        elif function == MapReducePlan.group_source:
+            if arg[1] is None:
+                amount = 1
+            else:
+                amount = data.get(arg[1]) or 0
+            return [{json.dumps(data.get(arg[0])): amount}]
+
+        plan = MapReducePlan.by_source(function)
+        if plan is None:
+            raise NotImplementedError('Unsupported map phase: %r' %
+                                      (function,))
+        for field, value in zip(plan.fields, arg):
+            if not (data and js_equal(data.get(field), value)):
+                return []
+        return [[bucket_name, key]]
+
+    def _reduce(self, function, arg, results):
+        if function == 'Riak.reduceSum':
+            return [sum(value for value in results if value)]
+        elif function == MapReducePlan.group_reduce_source:
+            groups = {}
+            for result in results:
+                for group, amount in result.iteritems():
+                    groups[group] = groups.get(group, 0) + amount
+            return [groups]
+        raise NotImplementedError('Unsupported reduce phase: %r' %
+                                  (function,))
+
+    def _index_keys(self, bucket_name, index, start, end=None):
+        # Riak compares the UTF-8 bytes
+        start, end = _index_value(start), _index_value(end)
+        retval = []
+        for key, record in sorted(self._records(bucket_name).items()):
+            if index == '$bucket':
+                retval += [(bucket_name, key)]
+                continue
+            # Riak indexes every key as $key
+            indexes = list(record.indexes) + [('$key', key)]
+            for field, value in indexes:
+                if field != index:
+                    continue
+                value = _index_value(value)
+                if ((end is None and value == start) or
+                        (end is not None and start <= value <= end)):
+                    retval += [(bucket_name, key)]
+                    break
+        return retval
+
+    def _search(self, bucket_name, query):
+        """(key, data) of the objects in `bucket_name` that match
+        `query`, by key."""
+        matches = SearchQuery(query).matches
+        retval = []
+        for key, record in sorted(self._records(bucket_name).items()):
+            data = self._decode(record) or {}
+            if matches(data):
+                retval += [(key, data)]
+        return retval
+
+    def _search_keys(self, bucket_name, query):
+        return [(bucket_name, key)
+                for key, data in self._search(bucket_name, query)]
+
+    def fulltext_search(self, index, query, **params):
+        """The Solr interface: takes rows, start, sort ("field [asc|desc]"
+        pairs separated by commas) and fl. Like Riak Search's JSON
+        extractor, documents hold the top level values as strings."""
+        self._round_trip()
+        docs = []
+        for key, data in self._search(index, query):
+            doc = dict((field, unicode(value))
+                       for field, value in data.iteritems()
+                       if value is not None and
+                          not isinstance(value, (dict, list)))
+            doc['id'] = key
+            docs += [doc]
+        for spec in reversed(params.get('sort', '').split(',')):
+            if not spec.strip():
+                continue
+            field, _, order = spec.strip().partition(' ')
+            docs.sort(key=lambda doc: (field not in doc,
+                                       search_order(doc.get(field))),
+                      reverse=order.strip() == 'desc')
+        num_found = len(docs)
+        start = int(params.get('start') or 0)
+        rows = params.get('rows')
+        if rows is None:
+            docs = docs[start:]
+        else:
+            docs = docs[start:start + int(rows)]
+        fl = params.get('fl')
+        if fl:
+            if isinstance(fl, basestring):
+                fl = fl.split(',')
+            docs = [dict((field, value) for field, value in doc.iteritems()
+                                        if field in fl or field == 'id')
+                    for doc in docs]
+        return {'num_found': num_found, 'max_score': 0.0, 'docs': docs}
+
+    def add(self, bucket_name):
+        return MemoryQuery(self, lambda: self._keys(bucket_name))
+
+    def index(self, bucket_name, index, start, end=None):
+        return MemoryQuery(self, lambda: self._index_keys(bucket_name, index,
+                                                          start, end))
+
+    def search(self, bucket_name, query):
+        return MemoryQuery(self, lambda: self._search_keys(bucket_name,
+                                                           query))
+
+
+def connect(host='127.0.0.1', port=8098, latency=0, pool_size=None,
+            async_pool_size=None, **kwargs):
+    """Point RiakAlchemy at a new, empty MemoryClient. Accepts the
+    arguments of riakalchemy.model.connect(), so the two are
+    interchangeable; only the pool sizes are used."""
+    if pool_size:
+        workers.default_concurrency = pool_size
+    if async_pool_size:
+        workers.async_concurrency = async_pool_size
+    model.client = MemoryClient(latency=latency)
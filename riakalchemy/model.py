@@ -17,31 +17,101 @@
 
     Where all the magic happens
 """
+import copy
 import json
-import riak
-import riak.client
-from riak.mapreduce import RiakLink
+import logging
+import re
 
-from riakalchemy.exceptions import ValidationError, NoSuchObjectError
+from riakalchemy.exceptions import (ValidationError, NoSuchObjectError,
+                                    DuplicateBucketError)
 from riakalchemy.types import RiakType
+from riakalchemy import codecs
+from riakalchemy import instrumentation
+from riakalchemy.instrumentation import instrumented
+from riakalchemy import resolvers
+from riakalchemy import sessions
+from riakalchemy import workers
+from riakalchemy.connection import ConnectionPool, PooledClient
 
 
 class RiakModelRegistry(object):
     def __init__(self):
-        self._registry = []
+        # bucket name -> the model that owns the bucket
+        self._registry = {}
 
     def register_model(self, cls):
         if cls.__name__ == 'RiakObject':
             return
-        self._registry += [cls]
+        existing = self._registry.get(cls.bucket_name)
+        if existing is None or (existing.__module__ == cls.__module__ and
+                                existing.__name__ == cls.__name__):
+            # New, or the same model defined again (e.g. on reload)
+            self._registry[cls.bucket_name] = cls
+        elif not cls.shares_bucket:
+            message = ('%s and %s both use bucket %r. Set shares_bucket = '
+                       'True on %s if that is intended.' %
+                       (existing.__name__, cls.__name__, cls.bucket_name,
+                        cls.__name__))
+            if strict_buckets:
+                raise DuplicateBucketError(message)
+            logging.getLogger('riakalchemy').warning(message)
 
     def class_by_bucket_name(self, bucket_name):
-        for model in self._registry:
-            if model.bucket_name == bucket_name:
-                return model
+        return self._registry.get(bucket_name)
 
 _registry = RiakModelRegistry()
 
+# Raise DuplicateBucketError, rather than log a warning, when a model
+# uses another model's bucket without setting shares_bucket
+strict_buckets = False
+
+# Marks a field that has no value
+_unset = object()
+
+# The quorum options each kind of request takes
+# (basic_quorum and notfound_ok are bucket properties, see
+# bucket_properties)
+_quorum_options = {'get': ('r', 'pr'),
+                   'store': ('w', 'dw', 'pw'),
+                   'delete': ('rw', 'r', 'w', 'dw', 'pr', 'pw')}
+
+
+def RiakLink(*args, **kwargs):
+    """riak.mapreduce.RiakLink, imported on first use so that importing
+    models doesn't pull in the Riak client"""
+    global RiakLink
+    from riak.mapreduce import RiakLink
+    return RiakLink(*args, **kwargs)
+
+
+def _snapshot(value):
+    if isinstance(value, (basestring, int, long, float, bool)):
+        return value
+    return copy.deepcopy(value)
+
+
+def _index_value(value):
+    """`value` as Riak compares 2i values: strings as UTF-8 bytes."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _fetch_links(links):
+    """Fetch the targets of `links`, grouping them by bucket so that
+    each bucket's keys are fetched concurrently in one go. Returns a
+    dict mapping (bucket name, key) to the loaded object."""
+    keys_by_bucket = {}
+    for link in links:
+        keys_by_bucket.setdefault(link[0], set()).add(link[1])
+
+    retval = {}
+    for bucket_name, keys in keys_by_bucket.iteritems():
+        cls = _registry.class_by_bucket_name(bucket_name)
+        for obj in cls.get_many(keys):
+            retval[(bucket_name, obj.key)] = obj
+    return retval
+
 
 class RiakObjectMeta(type):
     def __new__(cls, name, bases, attrs):
@@ -56,21 +126,76 @@ class RiakObjectMeta(type):
             meta[key] = attrs.pop(key)
 
         attrs['_meta'] = meta
+        # Field values are kept in slots instead of an instance __dict__
+        attrs['__slots__'] = (tuple(attrs.get('__slots__', ())) +
+                              tuple(sorted(meta)))
+        if callable(attrs.get('resolver')):
+            attrs['resolver'] = staticmethod(attrs['resolver'])
         new_class = super_new(cls, name, bases, attrs)
+
+        # Precomputed schema: (name, type, slot) for every field, split
+        # into plain values and relations
+        fields = [(key, meta[key], new_class.__dict__[key])
+                  for key in sorted(meta)]
+        new_class._scalar_fields = tuple(f for f in fields
+                                           if not f[1].link_type)
+        new_class._link_fields = tuple(f for f in fields if f[1].link_type)
+        new_class._link_types = dict((key, field_type)
+                                     for key, field_type, slot
+                                     in new_class._link_fields)
+        new_class._slots = dict((key, slot) for key, field_type, slot
+                                            in fields)
+        # load() can skip __init__ unless a subclass overrides it
+        new_class._custom_init = any('__init__' in c.__dict__
+                                     for c in new_class.__mro__[:-2])
         _registry.register_model(new_class)
         return new_class
 
 
 class RiakObject(object):
     __metaclass__ = RiakObjectMeta
+    # Subclasses get a slot per field on top of these. The __dict__ is
+    # only allocated if something else is stored on an instance.
+    __slots__ = ('key', '_links', '_riak_obj', '_resolved', '_saved_data',
+                 '_saved_payload', '_saved_links', '_deferred', '__dict__',
+                 '__weakref__')
     searchable = False
     debug = False
+    # Defaults to the pool_size given to connect()
+    fetch_concurrency = None
+    # How many aget()/asave()/... calls run at once. Defaults to the
+    # async_pool_size given to connect()
+    async_concurrency = None
+    # Read-through cache for get(key), see riakalchemy.cache
+    cache = None
+    # Extra bucket properties (n_val, allow_mult, ...) for this model
+    bucket_properties = None
+    # Picks the version to keep when Riak returns siblings, see
+    # riakalchemy.resolvers
+    resolver = resolvers.last_modified_wins
+    # Payload format, see riakalchemy.codecs. Defaults to
+    # codecs.default_codec.
+    codec = None
+    # Another model already uses this bucket, and that's intended. Links
+    # into the bucket load instances of the model defined first.
+    shares_bucket = False
+    # Queue saves and write them in the background, see
+    # riakalchemy.writebehind
+    write_behind = None
+    # Quorum options (r, w, dw, rw, pr, pw) for
+    # requests about this model, e.g. {'r': 1}. Cluster defaults apply
+    # to what is left out. get(), save(), delete() and friends take a
+    # `quorum` dict that overrides this per call.
+    quorum = None
 
     def __init__(self, **kwargs):
         self._links = []
         self.key = None
         self.update(kwargs)
         self._riak_obj = None
+        self._resolved = False
+        # Fields left out by a projection, see RiakObjectQuery.only()
+        self._deferred = None
 
     def __cmp__(self, other):
         if type(self) != type(other):
@@ -78,110 +203,654 @@ class RiakObject(object):
         return self.key == other.key
 
     @classmethod
-    def load(cls, riak_obj):
-        obj = cls(**riak_obj.data)
+    @instrumented('load')
+    def load(cls, riak_obj, fields=None):
+        """Build an object from `riak_obj`. If `fields` is given, the
+        other plain fields are only set (and compressed values
+        expanded) when first accessed."""
+        current = sessions.current()
+        if current is not None:
+            existing = current.lookup(cls, riak_obj.key)
+            if existing is not None:
+                return existing
+
+        resolved = cls._resolve_siblings(riak_obj)
+        # The payload to compare saves with, see _mark_stored()
+        codec = payload = None
+        if not resolved:
+            codec = cls._codec_for(riak_obj.content_type)
+        deferred = None
+        if fields is not None and not resolved:
+            data, deferred = cls._project(riak_obj, fields)
+        elif codec is None:
+            data = riak_obj.data
+        else:
+            # Decoded here rather than through riak_obj.data, which
+            # would drop the payload
+            payload = riak_obj.encoded_data
+            data = codec.decode(payload)
+        obj = cls._from_data(data)
+        obj._deferred = deferred
         obj.key = riak_obj.key
-        obj._links = riak_obj.links
+        obj._links = list(riak_obj.links)
         obj._riak_obj = riak_obj
+        if codec is None or cls._custom_init:
+            obj._mark_clean()
+        else:
+            obj._mark_stored(codec, payload or riak_obj.encoded_data)
+        # Make sure the next save() writes the resolved version back
+        obj._resolved = resolved
+        if current is not None:
+            obj = current.register(obj)
+        return obj
+
+    @classmethod
+    def _from_data(cls, data):
+        if cls._custom_init:
+            return cls(**(data or {}))
+        obj = cls.__new__(cls)
+        obj._set_data(data)
+        return obj
+
+    @classmethod
+    def _codec_for(cls, content_type):
+        if cls.codec is not None and cls.codec.content_type == content_type:
+            return cls.codec
+        return codecs.get(content_type)
+
+    @classmethod
+    def _project(cls, riak_obj, fields):
+        """Decode `riak_obj`, but leave everything but `fields` as it
+        was stored. Returns the decoded and the left out fields."""
+        codec = cls._codec_for(riak_obj.content_type)
+        if codec is None:
+            data = riak_obj.data or {}
+            expand = lambda value: value
+        else:
+            data = codec.loads(riak_obj.encoded_data) or {}
+            expand = codec.expand
+        loaded = {}
+        deferred = {}
+        for k, v in data.iteritems():
+            if k in fields or k not in cls._meta:
+                loaded[k] = expand(v)
+            else:
+                deferred[k] = v
+        return loaded, deferred
+
+    @classmethod
+    def _load_projected(cls, key, data):
+        """Build an object from a MapReducePlan.project_source result.
+        What was left out, relations included, is fetched from Riak when
+        first needed."""
+        current = sessions.current()
+        if current is not None:
+            existing = current.lookup(cls, key)
+            if existing is not None:
+                return existing
+
+        codec = cls._codec_for('application/json')
+        data = dict((k, codec.expand(v)) for k, v in data.iteritems())
+        obj = cls._from_data(data)
+        obj.key = key
+        obj._links = []
+        obj._riak_obj = None
+        obj._deferred = {}
+        obj._mark_clean()
+        if current is not None:
+            obj = current.register(obj)
         return obj
 
+    def _undefer(self, field):
+        value = self._deferred.pop(field)
+        codec = self._codec_for(self._riak_obj.content_type)
+        if codec is not None:
+            value = codec.expand(value)
+        self._slots[field].__set__(self, value)
+        if self._saved_data is not None:
+            self._saved_data[field] = _snapshot(value)
+
+    def _load_deferred(self):
+        """Load everything a projection left out."""
+        if self._deferred is None:
+            return
+        if self._riak_obj is None:
+            self._fetch_deferred()
+        else:
+            for field in list(self._deferred):
+                self._undefer(field)
+        self._deferred = None
+
+    @instrumented('fetch')
+    def _fetch_deferred(self):
+        instrumentation.round_trip()
+        riak_obj = client.bucket(self.bucket_name).get(
+            self.key, **self._quorum('get'))
+        self._set_fetched(riak_obj)
+
+    def _set_fetched(self, riak_obj):
+        """Fill in what a projection left out from `riak_obj`."""
+        if not riak_obj.exists:
+            raise NoSuchObjectError()
+        resolved = self._resolve_siblings(riak_obj)
+        data = riak_obj.data or {}
+        for field, field_type, slot in self._scalar_fields:
+            if field in data and not self._is_set(field):
+                slot.__set__(self, data[field])
+                self._saved()[field] = _snapshot(data[field])
+        self._riak_obj = riak_obj
+        self._links = list(riak_obj.links)
+        self._saved_links = list(self._links)
+        self._resolved = resolved
+
+    @classmethod
+    def resolve(cls, siblings):
+        """Return the one of `siblings` to keep. Uses `resolver` unless
+        overridden."""
+        return cls.resolver(siblings)
+
+    @classmethod
+    def _resolve_siblings(cls, riak_obj):
+        siblings = getattr(riak_obj, 'siblings', None)
+        if siblings and len(siblings) > 1:
+            riak_obj.siblings = [cls.resolve(list(siblings))]
+            return True
+        return False
+
+    def _set_data(self, data):
+        data = data or {}
+        found = 0
+        for field, field_type, slot in self._scalar_fields:
+            if field in data:
+                slot.__set__(self, data[field])
+                found += 1
+        if found < len(data):
+            # Keys that are not (or no longer) plain fields of the model
+            for k, v in data.iteritems():
+                if k not in self._meta or self._meta[k].link_type:
+                    setattr(self, k, v)
+
+    def _is_set(self, field):
+        try:
+            self._slots[field].__get__(self)
+        except AttributeError:
+            return False
+        return True
+
+    def _mark_clean(self):
+        """Remember the current state as the one stored in Riak."""
+        self._saved_data = dict((k, _snapshot(v))
+                                for k, v in self._data_dict().iteritems())
+        self._saved_payload = None
+        self._saved_links = list(self._links)
+        self._resolved = False
+
+    def _mark_stored(self, codec, payload):
+        """Like _mark_clean() for an object just decoded from
+        `payload`. Rather than copying the values up front, the payload
+        is decoded again when they are first compared."""
+        self._saved_data = None
+        self._saved_payload = (codec, payload)
+        self._saved_links = list(self._links)
+        self._resolved = False
+
+    def _saved(self):
+        """The field values stored in Riak, by field."""
+        if self._saved_data is None:
+            codec, payload = self._saved_payload
+            data = codec.decode(payload) or {}
+            deferred = self._deferred or {}
+            self._saved_data = dict((field, data[field])
+                                    for field, field_type, slot
+                                    in self._scalar_fields
+                                    if field in data and
+                                       field not in deferred)
+            self._saved_payload = None
+        return self._saved_data
+
+    def _data_dict(self):
+        data = {}
+        for field, field_type, slot in self._scalar_fields:
+            try:
+                data[field] = slot.__get__(self)
+            except AttributeError:
+                pass
+        return data
+
+    def changed_fields(self):
+        """Return the set of fields that have changed since the object
+        was loaded or last saved. Relations that have not been accessed
+        count as unchanged."""
+        if self._riak_obj is None and self._deferred is None:
+            return set(k for k in self._meta if self._is_set(k))
+
+        changed = set()
+        for field, field_type, slot in self._link_fields:
+            try:
+                value = slot.__get__(self)
+            except AttributeError:
+                continue
+            value = [(rel.bucket_name, rel.key) for rel in value]
+            saved = [(link[0], link[1]) for link in self._saved_links
+                                        if link[2] == field]
+            if value != saved:
+                changed.add(field)
+
+        saved_data = self._saved()
+        for field, field_type, slot in self._scalar_fields:
+            try:
+                value = slot.__get__(self)
+            except AttributeError:
+                value = _unset
+            if value != saved_data.get(field, _unset):
+                changed.add(field)
+        return changed
+
     def __getattr__(self, key):
-        if key in self._meta and self._meta[key].link_type:
-            retval = []
-            links = self._riak_obj.links
-            for link in links:
-                if link[2] == key:
-                    cls = _registry.class_by_bucket_name(link[0])
-                    retval += [cls.load(client.bucket(link[0]).get(link[1]))]
-            setattr(self, key, retval)
-            return retval
+        if key == '_deferred':
+            raise AttributeError(key)
+        deferred = self._deferred
+        if deferred is not None and key in self._meta:
+            if self._riak_obj is None:
+                self._load_deferred()
+                return getattr(self, key)
+            elif key in deferred:
+                self._undefer(key)
+                return getattr(self, key)
+
+        if key in self._link_types:
+            return self._load_relation(key)
 
         raise AttributeError('No such key: %s' % (key,))
 
+    @instrumented('traverse')
+    def _load_relation(self, key):
+        links = [link for link in self._riak_obj.links if link[2] == key]
+        related = _fetch_links(links)
+        retval = [related[(link[0], link[1])] for link in links
+                                              if (link[0], link[1])
+                                                 in related]
+        setattr(self, key, retval)
+        return retval
+
+    @classmethod
+    @instrumented('traverse')
+    def prefetch_related(cls, objs, *fields):
+        """Load the related objects in `fields` for all of `objs` at
+        once, rather than one link at a time on attribute access."""
+        for field in fields:
+            if field not in cls._link_types:
+                raise AttributeError('No such relation: %s' % (field,))
+        # Objects built from projections don't have their links yet
+        projected = [obj for obj in objs
+                     if obj._riak_obj is None and obj._deferred is not None]
+        if projected:
+            riak_objs = cls._fetch_from_riak([obj.key for obj
+                                              in projected]).get()
+            for obj, riak_obj in zip(projected, riak_objs):
+                if riak_obj.exists:
+                    obj._set_fetched(riak_obj)
+                    obj._deferred = None
+        for field in fields:
+            links = []
+            for obj in objs:
+                if obj._is_set(field) or not obj._riak_obj:
+                    continue
+                links += [(obj, [link for link in obj._riak_obj.links
+                                      if link[2] == field])]
+            related = _fetch_links(link for obj, obj_links in links
+                                        for link in obj_links)
+            for obj, obj_links in links:
+                setattr(obj, field, [related[(link[0], link[1])]
+                                     for link in obj_links
+                                     if (link[0], link[1]) in related])
+
     def json(self):
-        return json.dumps(dict((k, getattr(self, k)) for k in self._meta))
+        self._load_deferred()
+        data = {}
+        for field, field_type, slot in self._scalar_fields:
+            data[field] = slot.__get__(self)
+        for field, field_type, slot in self._link_fields:
+            data[field] = getattr(self, field)
+        return json.dumps(data)
 
     def update(self, d):
         for k, v in d.iteritems():
             setattr(self, k, v)
 
+    @instrumented('clean')
     def clean(self):
-        for field in self._meta:
-            if self._meta[field].required and not hasattr(self, field):
-                raise ValidationError('"%s" is required, but not set' %
-                                      (field,))
-
-            if self._meta[field].link_type:
-                value = getattr(self, field, [])
-                for rel in value:
-                    if not isinstance(rel, RiakObject):
-                        raise ValidationError('%s attribute of %s must be '
-                                              'another RiakObject' %
-                                              (field, self.__class__.__name__))
-
-                for link in self._links:
-                    if link.tag == field:
-                        self._riak_obj.links.remove(link)
-                        self._links.remove(link)
-
-                for link in value:
-                    self._links += [RiakLink(link.bucket_name,
-                                             link.key, tag=field)]
-            else:
-                if hasattr(self, field):
-                    value = self._meta[field].clean(getattr(self, field))
-                    setattr(self, field, value)
+        self._load_deferred()
+        for field, field_type, slot in self._link_fields:
+            try:
+                value = slot.__get__(self)
+            except AttributeError:
+                # The relation was never loaded or assigned, so its
+                # links are still what they were in Riak
+                if field_type.required and not self._riak_obj:
+                    raise ValidationError('"%s" is required, but not '
+                                          'set' % (field,))
+                continue
+
+            for rel in value:
+                if not isinstance(rel, RiakObject):
+                    raise ValidationError('%s attribute of %s must be '
+                                          'another RiakObject' %
+                                          (field, self.__class__.__name__))
+
+            self._links = ([link for link in self._links
+                                 if link[2] != field] +
+                           [RiakLink(rel.bucket_name, rel.key, tag=field)
+                            for rel in value])
+            field_type.validate(value)
 
-            if hasattr(self, field):
-                self._meta[field].validate(getattr(self, field))
+        for field, field_type, slot in self._scalar_fields:
+            try:
+                value = slot.__get__(self)
+            except AttributeError:
+                if field_type.required:
+                    raise ValidationError('"%s" is required, but not set' %
+                                          (field,))
+                continue
+            value = field_type.clean(value)
+            slot.__set__(self, value)
+            field_type.validate(value)
 
     @classmethod
-    def get(cls, key=None, **kwargs):
+    @instrumented('get')
+    def get(cls, key=None, quorum=None, **kwargs):
         if key:
+            current = sessions.current()
+            if current is not None:
+                existing = current.lookup(cls, key)
+                if existing is not None:
+                    return existing
             bucket = client.bucket(cls.bucket_name)
-            obj = bucket.get(key)
+            if cls.cache is not None:
+                cached = cls.cache.get(cls._cache_key(key))
+                if cached is not None:
+                    return cls.load(cls._riak_obj_from_cache(bucket, key,
+                                                             cached))
+            instrumentation.round_trip()
+            obj = bucket.get(key, **cls._quorum('get', quorum))
             if not obj.exists:
                 raise NoSuchObjectError()
-            return cls.load(obj)
-
-        if len(kwargs) == 1:
-            field = kwargs.keys()[0]
-            if cls._meta[field].link_type and cls._meta[field].backref:
-                bucket = client.bucket(cls.bucket_name)
-                _2i_key = '%s_bin' % (field,)
-                _2i_value = ('%s/%s' % (kwargs[field].bucket_name,
-                                        kwargs[field].key))
-                index_query = client.index(cls.bucket_name,
-                                           _2i_key, _2i_value)
-                return RiakObjectQuery(index_query, cls, True)
-        elif cls.searchable and kwargs:
+            loaded = cls.load(obj)
+            if cls.cache is not None:
+                cls.cache.set(cls._cache_key(key),
+                              {'data': obj.data,
+                               'links': list(obj.links),
+                               'indexes': list(obj.indexes),
+                               'vclock': obj.vclock})
+            return loaded
+
+        ranges = [(lookup, cls._index_range(lookup, value))
+                  for lookup, value in kwargs.iteritems()]
+        if ranges and all(index for lookup, index in ranges):
+            return cls.get_index([index for lookup, index in ranges])
+        if cls.searchable and kwargs:
             return cls.get_search(**kwargs)
-        else:
-            return cls.get_mr(**kwargs)
+
+        for lookup, index in ranges:
+            if '__' in lookup and index is None:
+                raise ValidationError('%s can only be used on fields with '
+                                      'index=True or on searchable '
+                                      'models' % (lookup,))
+        # The rest is matched by MapReduce, which can only compare plain
+        # fields. Lookups that need their index (ranges and backrefs)
+        # have it feed the keys into the map phase; one at most.
+        needs_index = [(lookup, index) for lookup, index in ranges
+                       if index and ('__' in lookup or
+                                     cls._meta[lookup].link_type)]
+        if len(needs_index) > 1:
+            raise ValidationError('%s cannot be combined with fields '
+                                  'without index=True' %
+                                  (', '.join(sorted(lookup for lookup, index
+                                                    in needs_index)),))
+        indexed = needs_index or [(lookup, index) for lookup, index in ranges
+                                  if index]
+        if indexed:
+            lookup, index = indexed[0]
+            values = dict(kwargs)
+            del values[lookup]
+            return cls._get_mr(values, index)
+        return cls.get_mr(**kwargs)
+
+    @classmethod
+    def _index_range(cls, lookup, value):
+        """Return (index, start, end) for a lookup like `age__gte` or
+        None if the field has no secondary index."""
+        field, _, op = lookup.partition('__')
+        if field not in cls._meta:
+            return None
+        field_type = cls._meta[field]
+        if field_type.link_type:
+            if not field_type.backref or op:
+                return None
+            return ('%s_bin' % (field,),
+                    '%s/%s' % (value.bucket_name, value.key), None)
+        if not field_type.index:
+            return None
+        start, end = field_type.index_range(op or 'eq', value)
+        return (field_type.index_name(field), _index_value(start),
+                _index_value(end))
+
+    @classmethod
+    def get_index(cls, ranges):
+        """Query the secondary indexes in `ranges`, a list of (index,
+        start, end) tuples. With more than one, only keys matched by
+        all of them are returned."""
+        queries = [client.index(cls.bucket_name, index, start, end)
+                   for index, start, end in ranges]
+        if len(queries) == 1:
+            new_query = lambda: client.index(cls.bucket_name, *ranges[0])
+            return RiakObjectQuery(queries[0], cls, True, index=ranges[0],
+                                   new_query=new_query)
+        return RiakObjectQuery(IndexIntersection(queries), cls, True)
+
+    @classmethod
+    def sync_bucket_properties(cls):
+        """Apply `bucket_properties` and the search hook (for searchable
+        models) to the model's bucket.
+
+        This happens automatically on the first save() per connection,
+        but can be called at deploy time to get it out of the way."""
+        bucket = client.bucket(cls.bucket_name)
+        if cls.bucket_properties:
+            instrumentation.round_trip()
+            bucket.set_properties(cls.bucket_properties)
+        if cls.searchable:
+            instrumentation.round_trip()
+            bucket.enable_search()
+        # Remember which connection we set things up for
+        cls._synced_client = client
+
+    @classmethod
+    def _bucket(cls):
+        if cls.__dict__.get('_synced_client') is not client:
+            cls.sync_bucket_properties()
+        return client.bucket(cls.bucket_name)
+
+    @classmethod
+    def _quorum(cls, request, overrides=None):
+        """The options to pass to Riak for a `request` ('get', 'store'
+        or 'delete')."""
+        options = dict(cls.quorum or {})
+        options.update(overrides or {})
+        for name in options:
+            if not any(name in names for names in _quorum_options.values()):
+                raise ValueError('Unknown quorum option: %s' % (name,))
+        return dict((name, value) for name, value in options.iteritems()
+                                  if name in _quorum_options[request])
+
+    @classmethod
+    def _cache_key(cls, key):
+        return '%s/%s' % (cls.bucket_name, key)
+
+    @classmethod
+    def _riak_obj_from_cache(cls, bucket, key, cached):
+        riak_obj = bucket.new(key, data=cached['data'])
+        riak_obj.links = cached['links']
+        for idx in cached['indexes']:
+            riak_obj.add_index(*idx)
+        riak_obj.vclock = cached['vclock']
+        return riak_obj
+
+    def _invalidate_cache(self):
+        if self.cache is not None and self.key is not None:
+            self.cache.delete(self._cache_key(self.key))
+
+    @classmethod
+    @instrumented('get_many')
+    def get_many(cls, keys, missing=None, quorum=None):
+        """Fetch the objects stored under `keys`, running up to
+        `fetch_concurrency` requests at a time.
+
+        The objects are returned in the same order as `keys`. Keys that
+        do not exist are skipped; if `missing` is a list, they are
+        appended to it."""
+        keys = list(keys)
+        return cls._load_many(keys, cls._fetch_many(keys, quorum).get(),
+                              missing)
+
+    @classmethod
+    @instrumented('exists')
+    def exists(cls, key):
+        """Whether an object is stored under `key`. Riak is asked
+        through the $key index, so the object itself isn't fetched."""
+        return cls._exists_many([key])[0]
+
+    @classmethod
+    @instrumented('exists')
+    def exists_many(cls, keys):
+        """exists() for all of `keys`, running up to `fetch_concurrency`
+        requests at a time. Returns a list of booleans in the same
+        order."""
+        return cls._exists_many(list(keys))
+
+    @classmethod
+    def _exists_many(cls, keys):
+        # Objects in the session or the cache don't need asking about
+        current = sessions.current()
+        known = [(current is not None and
+                  current.lookup(cls, key) is not None) or
+                 (cls.cache is not None and
+                  cls.cache.get(cls._cache_key(key)) is not None)
+                 for key in keys]
+        unknown = [key for key, exists in zip(keys, known) if not exists]
+        instrumentation.round_trip(len(unknown))
+        name = cls.bucket_name
+        # The bucket is looked up in the worker, so that every thread
+        # uses its own client (and node) from the connection pool
+        found = iter(workers.map_ordered(
+            lambda key: len(client.bucket(name).get_index('$key',
+                                                          key)) > 0,
+            unknown, cls.fetch_concurrency or workers.default_concurrency))
+        return [exists or found.next() for exists in known]
+
+    @classmethod
+    def _fetch_many(cls, keys, quorum=None):
+        current = sessions.current()
+        if current is not None:
+            return current.fetch_many(cls, keys, quorum)
+        return cls._fetch_from_riak(keys, quorum)
+
+    @classmethod
+    def _fetch_from_riak(cls, keys, quorum=None):
+        instrumentation.round_trip(len(keys))
+        name = cls.bucket_name
+        options = cls._quorum('get', quorum)
+        # See _exists_many() on why the bucket is looked up per key
+        return workers.map_async(lambda key: client.bucket(name).get(
+                                     key, **options),
+                                 keys,
+                                 cls.fetch_concurrency or
+                                 workers.default_concurrency)
+
+    @classmethod
+    def _load_many(cls, keys, riak_objs, missing=None, fields=None):
+        retval = []
+        for key, riak_obj in zip(keys, riak_objs):
+            if isinstance(riak_obj, RiakObject):
+                # From the session
+                retval += [riak_obj]
+            elif riak_obj.exists:
+                retval += [cls.load(riak_obj, fields)]
+            elif missing is not None:
+                missing += [key]
+        return retval
+
+    # Non-blocking variants of the above. They return a
+    # riakalchemy.workers.Future.
+
+    @classmethod
+    def aget(cls, key, quorum=None):
+        return workers.submit_to(cls.async_concurrency, cls.get, key,
+                                 quorum)
+
+    @classmethod
+    def aget_many(cls, keys, missing=None, quorum=None):
+        return workers.submit_to(cls.async_concurrency, cls.get_many, keys,
+                                 missing, quorum)
+
+    def asave(self, quorum=None):
+        return workers.submit_to(self.async_concurrency, self.save, quorum)
+
+    def adelete(self, quorum=None):
+        return workers.submit_to(self.async_concurrency, self.delete,
+                                 quorum)
+
+    def arelated(self, field):
+        """Load the relation `field` in the background."""
+        return workers.submit_to(self.async_concurrency, getattr, self,
+                                 field)
+
+    @classmethod
+    def get_search(cls, query=None, **kwargs):
+        """Riak Search for objects matching `query`, a query in Riak
+        Search syntax (ranges, OR, wildcards, ...), and the keyword
+        arguments. Those work like get()'s, with the lookups eq, gt,
+        gte, lt, lte, range, startswith and in. Everything is ANDed."""
+        terms = [cls._search_term(lookup, value)
+                 for lookup, value in kwargs.iteritems()]
+        if query:
+            terms = ['(%s)' % (query,)] + terms
+        terms = ' AND '.join(terms)
+        new_query = lambda: client.search(cls.bucket_name, terms)
+        return RiakObjectQuery(new_query(), cls, True, new_query=new_query,
+                               search=FullTextSearch(cls.bucket_name, terms))
 
     @classmethod
-    def get_search(cls, **kwargs):
-        terms = ' AND '.join(['%s:"%s"' % (k, v)
-                                               for k, v in kwargs.iteritems()])
-        query = client.search(cls.bucket_name, terms)
-        return RiakObjectQuery(query, cls, True)
+    def _search_term(cls, lookup, value):
+        field, _, op = lookup.partition('__')
+        if op in ('', 'eq'):
+            return '%s:%s' % (field, _search_quote(value))
+        elif op == 'in':
+            return '(%s)' % (' OR '.join('%s:%s' % (field, _search_quote(v))
+                                         for v in value),)
+        elif op == 'startswith':
+            return '%s:%s*' % (field, _search_escape(value))
+        elif op == 'range':
+            start, end = value
+            return '%s:[%s TO %s]' % (field, _search_escape(start),
+                                      _search_escape(end))
+        elif op in _search_ranges:
+            return '%s:%s' % (field,
+                              _search_ranges[op] % (_search_escape(value),))
+        raise ValidationError('Unsupported search lookup: %s' % (lookup,))
 
     @classmethod
     def get_mr(cls, **kwargs):
-        query = client.add(cls.bucket_name)
-        terms = (' && '.join(['data'] +
-                 ['data.%s=="%s"' % (k, v) for k, v in kwargs.iteritems()]))
-        map_func = """function(v) {
-                          json_string = v.values[0].data;
-                          if (json_string == '') return [];
-                          var data = JSON.parse(json_string);
-                          if(%s) {
-                              return [v.key];
-                          }
-                          return [];
-                      }""" % (terms,)
-        query.map(map_func)
-        return RiakObjectQuery(query, cls, False)
+        return cls._get_mr(kwargs)
+
+    @classmethod
+    def _get_mr(cls, values, index=None):
+        """Match `values` with MapReduce, over the keys in the secondary
+        index range `index` (see get_index()) if given, otherwise over
+        the whole bucket."""
+        plan = MapReducePlan.for_fields(values.keys())
+        new_query = lambda: plan.query(cls.bucket_name, values, index)
+        return RiakObjectQuery(new_query(), cls, True, new_query=new_query)
 
     def pre_delete(self):
         pass
@@ -189,72 +858,734 @@ class RiakObject(object):
     def post_delete(self):
         pass
 
-    def delete(self):
+    @instrumented('delete')
+    def delete(self, quorum=None):
+        if self._riak_obj is None and self._deferred is not None:
+            self._load_deferred()
         if self._riak_obj:
             self.pre_delete()
-            self._riak_obj.delete()
+            self._delete(quorum)
             self.post_delete()
 
+    def _delete(self, quorum=None):
+        if self.write_behind is not None:
+            self.write_behind.discard(self)
+            if self.key is None:
+                # Was never written
+                return
+        instrumentation.round_trip()
+        # See _store()
+        client.delete(self._riak_obj, **self._quorum('delete', quorum))
+        self._riak_obj.clear()
+        current = sessions.current()
+        if current is not None:
+            current.discard(self)
+        self._invalidate_cache()
+
     def post_save(self):
         pass
 
     def pre_save(self):
         pass
 
-    def save(self):
+    @instrumented('save')
+    def save(self, quorum=None):
+        if self._prepare_save():
+            if self.write_behind is not None:
+                # post_save() runs once the object has been written
+                self.write_behind.add(self, self._write_snapshot(), quorum)
+                return
+            self._store(quorum)
+        self.post_save()
+
+    def _prepare_save(self):
+        """Run pre_save() and clean() and bring the Riak object up to
+        date. Returns False if there is nothing to write."""
         self.pre_save()
         self.clean()
-        bucket = client.bucket(self.bucket_name)
+        changed = self.changed_fields()
+        if self._riak_obj and not changed and not self._resolved:
+            return False
 
-        # Ideally, this should live in the metaclass, but since we don't
-        # have a connection there yet..
-        if self.searchable:
-            bucket.enable_search()
+        bucket = self._bucket()
+        if not self._riak_obj:
+            self._riak_obj = bucket.new(self.key)
+            # Until the first store() succeeds, nothing is saved
+            self._saved_data = {}
+            self._saved_links = []
+        self._encode()
 
-        data_dict = dict((k, getattr(self, k)) for k in self._meta
-                                                if not self._meta[k].link_type
-                                                   and hasattr(self, k))
-        if self._riak_obj:
-            self._riak_obj.data = data_dict
+        self._riak_obj.links = list(self._links)
+
+        # Only touch the indexes of fields that actually changed
+        for field in changed:
+            field_type = self._meta[field]
+            if field_type.link_type and field_type.backref:
+                index = '%s_bin' % (field,)
+                new = set('%s/%s' % (link[0], link[1])
+                          for link in self._links if link[2] == field)
+            elif not field_type.link_type and field_type.index:
+                index = field_type.index_name(field)
+                value = getattr(self, field, None)
+                if value is None:
+                    new = set()
+                else:
+                    new = set([value])
+            else:
+                continue
+            old = set(v for (f, v) in self._riak_obj.indexes if f == index)
+            for value in old - new:
+                self._riak_obj.remove_index(index, value)
+            for value in new - old:
+                self._riak_obj.add_index(index, value)
+        return True
+
+    @instrumented('encode')
+    def _encode(self):
+        codec = self.codec or codecs.default_codec
+        self._riak_obj.content_type = codec.content_type
+        self._riak_obj.encoded_data = codec.encode(self._data_dict())
+
+    @instrumented('store')
+    def _store(self, quorum=None):
+        instrumentation.round_trip()
+        # Through the calling thread's client rather than the one that
+        # loaded the object, so that save_many() spreads the load
+        client.put(self._riak_obj, **self._quorum('store', quorum))
+        self.key = self._riak_obj.key
+        current = sessions.current()
+        if current is not None:
+            current.register(self)
+        self._mark_clean()
+        self._invalidate_cache()
+
+    def _write_snapshot(self):
+        """Copy what _prepare_save() left in the Riak object, along with
+        the state it represents, so that _store_snapshot() can write it
+        later no matter what happens to the object in the meantime."""
+        riak_obj = self._riak_obj
+        return {'content_type': riak_obj.content_type,
+                'encoded_data': riak_obj.encoded_data,
+                'links': list(riak_obj.links),
+                'indexes': list(riak_obj.indexes),
+                'saved_data': dict((k, _snapshot(v)) for k, v
+                                   in self._data_dict().iteritems()),
+                'saved_links': list(self._links)}
+
+    @instrumented('store')
+    def _store_snapshot(self, snapshot, quorum=None):
+        """Store a _write_snapshot() through a Riak object of its own,
+        leaving self._riak_obj to save()s made in the meantime."""
+        riak_obj = client.bucket(self.bucket_name).new(self.key)
+        riak_obj.content_type = snapshot['content_type']
+        riak_obj.encoded_data = snapshot['encoded_data']
+        riak_obj.links = list(snapshot['links'])
+        for idx in snapshot['indexes']:
+            riak_obj.add_index(*idx)
+        riak_obj.vclock = self._riak_obj.vclock
+        instrumentation.round_trip()
+        riak_obj.store(**self._quorum('store', quorum))
+        self._riak_obj.vclock = riak_obj.vclock
+        if self.key is None:
+            self.key = self._riak_obj.key = riak_obj.key
+        self._saved_data = snapshot['saved_data']
+        self._saved_links = snapshot['saved_links']
+        self._resolved = False
+        self._invalidate_cache()
+
+    @classmethod
+    @instrumented('save_many')
+    def save_many(cls, objs, concurrency=None, retries=2, retry_delay=0.1,
+                  quorum=None):
+        """Save all of `objs`, writing up to `concurrency` of them at a
+        time. Failed writes are retried `retries` times, waiting
+        `retry_delay` seconds (doubling every time) in between.
+
+        Errors do not stop the batch; they are collected in the returned
+        BulkResult."""
+        result = BulkResult()
+        pending = []
+        for obj in objs:
+            try:
+                if obj._prepare_save():
+                    pending += [obj]
+                    continue
+                obj.post_save()
+            except Exception as e:
+                result.failed += [(obj, e)]
+            else:
+                result.succeeded += [obj]
+
+        def store(obj):
+            return workers.attempt(lambda: obj._store(quorum), retries,
+                                   retry_delay)
+
+        errors = workers.map_ordered(store, pending,
+                                     concurrency or cls.fetch_concurrency or
+                                     workers.default_concurrency)
+        for obj, error in zip(pending, errors):
+            if error is None:
+                try:
+                    obj.post_save()
+                except Exception as e:
+                    error = e
+            if error is None:
+                result.succeeded += [obj]
+            else:
+                result.failed += [(obj, error)]
+        return result
+
+    @classmethod
+    @instrumented('delete_many')
+    def delete_many(cls, objs, concurrency=None, retries=2, retry_delay=0.1,
+                    quorum=None):
+        """Delete all of `objs` concurrently. See save_many()."""
+        result = BulkResult()
+        pending = []
+        for obj in objs:
+            if obj._riak_obj is None and obj._deferred is not None:
+                try:
+                    obj._load_deferred()
+                except Exception as e:
+                    result.failed += [(obj, e)]
+                    continue
+            if not obj._riak_obj:
+                continue
+            try:
+                obj.pre_delete()
+            except Exception as e:
+                result.failed += [(obj, e)]
+            else:
+                pending += [obj]
+
+        def delete(obj):
+            return workers.attempt(lambda: obj._delete(quorum), retries,
+                                   retry_delay)
+
+        errors = workers.map_ordered(delete, pending,
+                                     concurrency or cls.fetch_concurrency or
+                                     workers.default_concurrency)
+        for obj, error in zip(pending, errors):
+            if error is None:
+                try:
+                    obj.post_delete()
+                except Exception as e:
+                    error = e
+            if error is None:
+                result.succeeded += [obj]
+            else:
+                result.failed += [(obj, error)]
+        return result
+
+
+class BulkResult(object):
+    """Outcome of save_many() and delete_many(): `succeeded` holds the
+    objects that went through, `failed` holds (object, exception)
+    pairs for the rest."""
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+class MapReducePlan(object):
+    """A map phase that picks out the keys of objects whose `fields`
+    match a set of values.
+
+    The JavaScript source only depends on the field names, so it is
+    built once per field set and cached. The values are passed as the
+    phase argument, which means they need no escaping and Riak sees the
+    same function for every query on those fields."""
+    _cache = {}
+    # Plans by map source, so backends without a JavaScript VM can tell
+    # what a phase is supposed to do (see riakalchemy.memory)
+    _by_source = {}
+
+    map_template = """function(v, keyData, arg) {
+                          var json_string = v.values[0].data;
+                          if (json_string == '') return [];
+                          var data = JSON.parse(json_string);
+                          if(%s) {
+                              return [[v.bucket, v.key]];
+                          }
+                          return [];
+                      }"""
+
+    # Picks the fields in `arg` out of every object
+    project_source = """function(v, keyData, arg) {
+                            var json_string = v.values[0].data;
+                            if (json_string == '') return [];
+                            var data = JSON.parse(json_string);
+                            var projected = {};
+                            for (var i = 0; i < arg.length; i++) {
+                                if (arg[i] in data) {
+                                    projected[arg[i]] = data[arg[i]];
+                                }
+                            }
+                            return [[v.key, projected]];
+                        }"""
+
+    # Aggregation phases, see RiakObjectQuery.count() and friends
+    count_source = """function(v) {
+                          return [1];
+                      }"""
+
+    value_source = """function(v, keyData, arg) {
+                          var json_string = v.values[0].data;
+                          if (json_string == '') return [];
+                          var data = JSON.parse(json_string);
+                          if (arg in data) return [data[arg]];
+                          return [];
+                      }"""
+
+    # arg is [group field, field to sum or null to count]
+    group_source = """function(v, keyData, arg) {
+                          var json_string = v.values[0].data;
+                          if (json_string == '') return [];
+                          var data = JSON.parse(json_string);
+                          var group = data[arg[0]];
+                          if (group === undefined) group = null;
+                          var groups = {};
+                          groups[JSON.stringify(group)] =
+                              arg[1] === null ? 1 : (data[arg[1]] || 0);
+                          return [groups];
+                      }"""
+
+    group_reduce_source = """function(values) {
+                                 var groups = {};
+                                 for (var i = 0; i < values.length; i++) {
+                                     for (var k in values[i]) {
+                                         groups[k] = (groups[k] || 0) +
+                                                     values[i][k];
+                                     }
+                                 }
+                                 return [groups];
+                             }"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        terms = ' && '.join(['data'] +
+                            ['data[%s] == arg[%d]' % (json.dumps(field), i)
+                             for i, field in enumerate(fields)])
+        self.map_source = self.map_template % (terms,)
+
+    @classmethod
+    def for_fields(cls, fields):
+        fields = tuple(sorted(fields))
+        plan = cls._cache.get(fields)
+        if plan is None:
+            plan = cls._cache.setdefault(fields, cls(fields))
+            cls._by_source[plan.map_source] = plan
+        return plan
+
+    @classmethod
+    def by_source(cls, source):
+        return cls._by_source.get(source)
+
+    def arg(self, values):
+        return [_mr_value(values[field]) for field in self.fields]
+
+    def query(self, bucket_name, values, index=None):
+        if index is None:
+            query = client.add(bucket_name)
         else:
-            self._riak_obj = bucket.new(self.key, data=data_dict)
+            query = client.index(bucket_name, *index)
+        query.map(self.map_source, {'arg': self.arg(values)})
+        return query
 
-        # Remove all existing links and indexes
-        self._riak_obj.links = []
 
-        indexes = self._riak_obj.indexes
-        for idx in list(indexes):
-            self._riak_obj.remove_index(*idx)
+_search_ranges = {'gt': '{%s TO *}', 'gte': '[%s TO *]',
+                  'lt': '{* TO %s}', 'lte': '[* TO %s]'}
 
-        # ..and add the new set of links
-        self._riak_obj.links = self._links
 
-        for field in self._meta:
-            if self._meta[field].link_type and self._meta[field].backref:
-                value = getattr(self, field)
-                for link in value:
-                    self._riak_obj.add_index('%s_bin' % (field,),
-                                             '%s/%s' % (link.bucket_name,
-                                                        link.key))
+def _search_quote(value):
+    return '"%s"' % (re.sub(r'(["\\])', r'\\\1', '%s' % (value,)),)
 
-        self._riak_obj.store()
-        self.key = self._riak_obj.key
-        self.post_save()
+
+def _search_escape(value):
+    return re.sub(r'([-+&|!(){}\[\]^"~*?:\\/\s])', r'\\\1', '%s' % (value,))
+
+
+def _mr_value(value):
+    if value is None or isinstance(value, (basestring, int, long, float,
+                                           bool)):
+        return value
+    return str(value)
+
+
+class IndexIntersection(object):
+    """Runs several 2i queries side by side and keeps the results that
+    all of them return, in the order the first query returned them."""
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def run(self):
+        instrumentation.round_trip(len(self.queries))
+        results = workers.map_ordered(lambda query: query.run(),
+                                      self.queries,
+                                      min(len(self.queries),
+                                          workers.default_concurrency))
+        common = set(result[1] for result in results[0])
+        for other in results[1:]:
+            common &= set(result[1] for result in other)
+        retval = []
+        for result in results[0]:
+            if result[1] in common:
+                common.discard(result[1])
+                retval += [result]
+        return retval
+
+
+class FullTextSearch(object):
+    """A Riak Search query made through the Solr interface, which,
+    unlike search MapReduce inputs, takes rows, start, sort and field
+    lists."""
+
+    def __init__(self, bucket_name, query):
+        self.bucket_name = bucket_name
+        self.query = query
+        # rows, start and sort
+        self.params = {}
+
+    def docs(self, fields=None, **params):
+        """The matching documents, with only `fields` (and the key, as
+        `id`) in them if given. `params` override `self.params`."""
+        instrumentation.round_trip()
+        params = dict(self.params, **params)
+        if fields is not None:
+            fl = ['id'] + sorted(fields)
+            # Only the protocol buffers client takes lists
+            if getattr(client, 'protocol', 'http') != 'pbc':
+                fl = ','.join(fl)
+            params['fl'] = fl
+        return client.fulltext_search(self.bucket_name, self.query,
+                                      **params)['docs']
+
+    def run(self, **params):
+        return [(self.bucket_name, doc['id'])
+                for doc in self.docs(['id'], **params)]
 
 
 class RiakObjectQuery(object):
-    def __init__(self, query, cls, gives_links):
+    batch_size = 100
+
+    def __init__(self, query, cls, gives_links, index=None, new_query=None,
+                 search=None):
         self.query = query
         self.cls = cls
         self.gives_links = gives_links
+        # (index name, start, end) when the query is a plain 2i lookup,
+        # so that we can page through it instead of running it
+        self.index = index
+        self.prefetch_fields = ()
+        # Builds a fresh copy of `query` to add phases to (projections,
+        # aggregations). None if the query isn't MapReduce.
+        self.new_query = new_query
+        self.only_fields = None
+        self.deferred_fields = ()
+        # A FullTextSearch for the same query if it is a search. Paging
+        # and sorting go through it, and so does all() if the fields it
+        # needs are in the search documents.
+        self.search = search
 
-    def all(self):
-        bucket = client.bucket(self.cls.bucket_name)
+    def prefetch(self, *fields):
+        """Load the given relations for every object in the result set
+        in one pass per batch."""
+        self.prefetch_fields += fields
+        return self
+
+    def only(self, *fields):
+        """Only set `fields` of every object up front. The others are
+        set when first accessed. Objects fetched from Riak are still
+        decoded whole, but compressed values of the other fields aren't
+        expanded until then.
+
+        If the query runs as MapReduce, all() picks the fields out on
+        the server and doesn't fetch the objects at all."""
+        self._check_fields(fields)
+        self.only_fields = fields
+        return self
+
+    def defer(self, *fields):
+        """Leave `fields` out until they are accessed. See only()."""
+        self._check_fields(fields)
+        self.deferred_fields += fields
+        return self
+
+    def limit(self, rows, start=0):
+        """Only return `rows` objects, skipping the first `start`.
+        Search queries only."""
+        self._check_search('limit')
+        self.search.params.update(rows=rows, start=start)
+        return self
+
+    def order_by(self, *fields):
+        """Sort by `fields`; prefix a field with - to sort in descending
+        order. Search queries only."""
+        self._check_search('order_by')
+        self._check_fields([field.lstrip('-') for field in fields])
+        self.search.params['sort'] = ','.join(
+            field.startswith('-') and '%s desc' % (field[1:],) or field
+            for field in fields)
+        return self
+
+    def _check_search(self, method):
+        if self.search is None:
+            raise ValueError('%s() only works on search queries' %
+                             (method,))
+
+    def _paged(self):
+        """Whether the keys have to come from the search interface,
+        which is the case once limit() or order_by() is used."""
+        return self.search is not None and bool(self.search.params)
+
+    def _check_fields(self, fields):
+        for field in fields:
+            if (field not in self.cls._meta or
+                    field in self.cls._link_types):
+                raise AttributeError('No such field: %s' % (field,))
+
+    def _fields(self):
+        if self.only_fields is None and not self.deferred_fields:
+            return None
+        return frozenset(field for field, field_type, slot
+                               in self.cls._scalar_fields
+                               if (self.only_fields is None or
+                                   field in self.only_fields) and
+                                  field not in self.deferred_fields)
+
+    def _load(self, keys, riak_objs, missing=None):
+        objs = self.cls._load_many(keys, riak_objs, missing, self._fields())
+        self._prefetch(objs)
+        return objs
+
+    def _prefetch(self, objs):
+        if self.prefetch_fields:
+            self.cls.prefetch_related(objs, *self.prefetch_fields)
+
+    def _unwrap(self, result):
         if self.gives_links:
-            unwrap = lambda x: bucket.get(x[1])
+            return result[1]
+        return result
+
+    def _run(self, query):
+        if not isinstance(query, (IndexIntersection, FullTextSearch)):
+            instrumentation.round_trip()
+        return query.run()
+
+    def _keys(self):
+        if self._paged():
+            return [key for bucket, key in self._run(self.search)]
+        return [self._unwrap(x) for x in self._run(self.query)]
+
+    def _iter_keys(self, page_size):
+        bucket = client.bucket(self.cls.bucket_name)
+        if self.index and hasattr(bucket, 'stream_index'):
+            # This client speaks paginated 2i
+            index, start, end = self.index
+            continuation = None
+            while True:
+                instrumentation.round_trip()
+                page = bucket.get_index(index, start, end,
+                                        max_results=page_size,
+                                        continuation=continuation)
+                for key in page.results:
+                    yield key
+                continuation = page.continuation
+                if not continuation:
+                    return
+        elif hasattr(self.query, 'stream') and not self._paged():
+            instrumentation.round_trip()
+            stream = self.query.stream()
+            try:
+                for phase, results in stream:
+                    for result in results:
+                        yield self._unwrap(result)
+            finally:
+                if hasattr(stream, 'close'):
+                    stream.close()
         else:
-            unwrap = lambda x: bucket.get(x)
-        return [self.cls.load(unwrap(x)) for x in self.query.run()]
+            for key in self._keys():
+                yield key
+
+    def iter_batches(self, n=None, prefetch=True):
+        """Yield lists of at most `n` objects as they are fetched.
+
+        With `prefetch`, the next batch is fetched while the caller is
+        busy with the current one."""
+        n = n or self.batch_size
+        pending = None
+        for keys in workers.chunked(self._iter_keys(n), n):
+            fetch = (keys, self.cls._fetch_many(keys))
+            if not prefetch:
+                pending, fetch = fetch, None
+            if pending is not None:
+                batch = self._load(pending[0], pending[1].get())
+                if batch:
+                    yield batch
+            pending = fetch
+        if pending is not None:
+            batch = self._load(pending[0], pending[1].get())
+            if batch:
+                yield batch
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for obj in batch:
+                yield obj
+
+    @instrumented('query')
+    def keys(self):
+        """The keys of the objects matched, without fetching the
+        objects."""
+        return self._keys()
+
+    def iter_keys(self, page_size=None):
+        """Like keys(), but yields the keys as Riak returns them: 2i
+        queries are paged, MapReduce queries streamed."""
+        return self._iter_keys(page_size or self.batch_size)
+
+    @instrumented('query')
+    def first(self):
+        if self.search is not None:
+            keys = [key for bucket, key in self.search.run(rows=1)]
+            objs = self._load(keys, self.cls._fetch_many(keys).get())
+            return objs[0] if objs else None
+        for batch in self.iter_batches(1, prefetch=False):
+            return batch[0]
+        return None
+
+    @instrumented('query')
+    def all(self, missing=None, quorum=None):
+        fields = self._fields()
+        if (fields is not None and self.search is not None and
+                all(self.cls._meta[field].search_stored
+                    for field in fields)):
+            objs = [self.cls._load_projected(doc['id'],
+                                             self._from_search_doc(doc))
+                    for doc in self.search.docs(fields)]
+            self._prefetch(objs)
+            return objs
+        if (fields is not None and self.new_query is not None and
+                not self._paged()):
+            query = self.new_query()
+            query.map(MapReducePlan.project_source, {'arg': sorted(fields)})
+            objs = [self.cls._load_projected(key, data)
+                    for key, data in self._run(query)]
+            self._prefetch(objs)
+            return objs
+        keys = self._keys()
+        return self._load(keys, self.cls._fetch_many(keys, quorum).get(),
+                          missing)
+
+    def _from_search_doc(self, doc):
+        # Search documents hold strings, clean() turns them back into
+        # the field's type
+        return dict((field, self.cls._meta[field].clean(value))
+                    for field, value in doc.iteritems()
+                    if field in self.cls._meta)
+
+    def aall(self, missing=None, quorum=None):
+        """Non-blocking all(). Returns a riakalchemy.workers.Future."""
+        return workers.submit(self.all, missing, quorum)
+
+    # Aggregations. Where the query runs as MapReduce, they are worked
+    # out by Riak and only the result is sent back; otherwise the
+    # objects are fetched and the work is done here.
+
+    def _check_scalar(self, field):
+        if not (field in self.cls._meta and
+                not self.cls._meta[field].link_type):
+            raise AttributeError('No such field: %s' % (field,))
+
+    def _aggregate(self, map_source, arg, reduce_source=None):
+        query = self.new_query()
+        query.map(map_source, {'arg': arg})
+        if reduce_source:
+            query.reduce(reduce_source)
+        return self._run(query)
+
+    def _fetch(self, *fields):
+        keys = self._keys()
+        return self.cls._load_many(keys, self.cls._fetch_many(keys).get(),
+                                   fields=frozenset(fields))
+
+    @instrumented('aggregate')
+    def count(self):
+        """The number of objects matched. 2i queries only fetch the
+        keys."""
+        if self.new_query is None or self.index is not None:
+            return len(self._keys())
+        results = self._aggregate(MapReducePlan.count_source, None,
+                                  'Riak.reduceSum')
+        return results[0] if results else 0
+
+    @instrumented('aggregate')
+    def sum(self, field):
+        """The sum of `field` over the objects matched."""
+        self._check_scalar(field)
+        if self.new_query is None:
+            return sum(getattr(obj, field) or 0 for obj in self._fetch(field)
+                                                if obj._is_set(field))
+        results = self._aggregate(MapReducePlan.value_source, field,
+                                  'Riak.reduceSum')
+        return results[0] if results else 0
+
+    @instrumented('aggregate')
+    def values_list(self, field):
+        """The values of `field` of the objects matched that have one,
+        in no particular order."""
+        self._check_scalar(field)
+        if self.new_query is None:
+            return [getattr(obj, field) for obj in self._fetch(field)
+                                        if obj._is_set(field)]
+        return self._aggregate(MapReducePlan.value_source, field)
+
+    def group_by(self, field):
+        self._check_scalar(field)
+        return GroupedQuery(self, field)
+
+
+class GroupedQuery(object):
+    """Per value of `field`, counts or sums the objects matched by
+    `query`. Objects without a value end up in the None group."""
+
+    def __init__(self, query, field):
+        self.query = query
+        self.cls = query.cls
+        self.field = field
+
+    @instrumented('aggregate')
+    def _groups(self, sum_field):
+        if self.query.new_query is None:
+            groups = {}
+            for obj in self.query._fetch(self.field, sum_field):
+                group = getattr(obj, self.field, None)
+                if sum_field:
+                    amount = getattr(obj, sum_field, None) or 0
+                else:
+                    amount = 1
+                groups[group] = groups.get(group, 0) + amount
+            return groups
+        results = self.query._aggregate(MapReducePlan.group_source,
+                                        [self.field, sum_field],
+                                        MapReducePlan.group_reduce_source)
+        if not results:
+            return {}
+        return dict((json.loads(group), amount)
+                    for group, amount in results[0].iteritems())
+
+    def count(self):
+        return self._groups(None)
+
+    def sum(self, field):
+        self.query._check_scalar(field)
+        return self._groups(field)
 
 client = None
 _test_server = None
@@ -265,7 +1596,19 @@ def reset_registry():
     _registry = RiakModelRegistry()
 
 
-def connect(host='127.0.0.1', port=8098, test_server=False):
+def connect(host='127.0.0.1', port=8098, test_server=False, nodes=None,
+            protocol='http', pb_port=8087, pool_size=None,
+            strategy='round_robin', async_pool_size=None):
+    """Set up the connection to Riak.
+
+    `nodes` is a list of host names, (host, http_port, pb_port) tuples
+    or dicts with those keys; if left out, `host`, `port` and `pb_port`
+    describe the single node to use. `protocol` is either 'http' or
+    'pb'. Each thread gets its own persistent client bound to one of
+    the nodes, picked according to `strategy` ('round_robin' or
+    'least_loaded'). `pool_size` sets how many requests batch
+    operations keep in flight, `async_pool_size` how many aget(),
+    asave() etc. calls run at once."""
     global client
     if test_server:
         global _test_server
@@ -282,8 +1625,16 @@ def connect(host='127.0.0.1', port=8098, test_server=False):
         _test_server.cleanup()
         _test_server.prepare()
         _test_server.start()
+        pb_port = port + 2
 
-    client = riak.RiakClient(host=host, http_port=port)
+    if nodes is None:
+        nodes = [(host, port, pb_port)]
+    if pool_size:
+        workers.default_concurrency = pool_size
+    if async_pool_size:
+        workers.async_concurrency = async_pool_size
+    client = PooledClient(ConnectionPool(nodes, protocol=protocol,
+                                         strategy=strategy))
 
 
 def _clear_test_connection():
@@ -0,0 +1,85 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Sibling resolvers
+
+    A resolver takes the list of siblings of a conflicted Riak object
+    (each with data, links, indexes and last_modified attributes) and
+    returns the single sibling to keep. Set one as the `resolver`
+    attribute of a model, or override the model's resolve() method.
+"""
+
+
+def _by_age(siblings):
+    return sorted(siblings, key=lambda s: s.last_modified or 0)
+
+
+def last_modified_wins(siblings):
+    """Keep the most recently written sibling."""
+    return _by_age(siblings)[-1]
+
+
+def _indexed_field(index):
+    # 'age_int' -> 'age'
+    return index.rsplit('_', 1)[0]
+
+
+def merge_fields(siblings):
+    """Merge the siblings' data field by field. Where siblings disagree
+    on a field, the most recently written one wins; fields missing from
+    newer siblings are kept from older ones, along with their
+    indexes."""
+    siblings = _by_age(siblings)
+    data = {}
+    source = {}
+    for sibling in siblings:
+        for field, value in (sibling.data or {}).iteritems():
+            data[field] = value
+            source[field] = sibling
+
+    winner = siblings[-1]
+    indexes = set(idx for idx in winner.indexes
+                      if _indexed_field(idx[0]) not in source)
+    for field, sibling in source.iteritems():
+        indexes |= set(idx for idx in sibling.indexes
+                           if _indexed_field(idx[0]) == field)
+    winner.data = data
+    winner.indexes = indexes
+    return winner
+
+
+def union_relations(siblings):
+    """Like merge_fields, but relations end up with the union of the
+    related objects of all siblings (along with their backref
+    indexes)."""
+    winner = merge_fields(siblings)
+    links = []
+    seen = set()
+    for sibling in siblings:
+        for link in sibling.links:
+            if tuple(link) not in seen:
+                seen.add(tuple(link))
+                links += [link]
+
+    relation_indexes = set(('%s_bin' % (link[2],),
+                            '%s/%s' % (link[0], link[1])) for link in links)
+    indexes = set(winner.indexes)
+    for sibling in siblings:
+        indexes |= set(sibling.indexes) & relation_indexes
+    winner.links = links
+    winner.indexes = indexes
+    return winner
@@ -0,0 +1,145 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Sessions: an identity map and unit of work
+
+    Inside `with riakalchemy.session():` every object is loaded at most
+    once. Fetching it again, by key, through a relation or as a query
+    result, gives back the same instance without asking Riak. Changed
+    objects (and new ones passed to add()) are saved in one batch when
+    the block ends.
+
+    Sessions belong to the thread that started them; calls that run in
+    the background (aget() and friends) don't use them.
+"""
+import threading
+
+from riakalchemy.exceptions import FlushError
+
+_local = threading.local()
+
+
+def current():
+    """The innermost active session of this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+class _Merged(object):
+    """Results of a fetch that was partly served from a session"""
+
+    def __init__(self, known, pending):
+        self.known = known
+        self.pending = pending
+
+    def get(self, timeout=None):
+        fetched = iter(self.pending.get(timeout))
+        return [obj if obj is not None else fetched.next()
+                for obj in self.known]
+
+
+class Session(object):
+    def __init__(self, flush_on_exit=True):
+        self.flush_on_exit = flush_on_exit
+        # (bucket name, key) -> object
+        self.identity_map = {}
+        self.new = []
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.stack.remove(self)
+        if exc_type is None and self.flush_on_exit:
+            self.flush()
+
+    def lookup(self, cls, key):
+        obj = self.identity_map.get((cls.bucket_name, key))
+        # Several models can share a bucket
+        if type(obj) is cls:
+            return obj
+        return None
+
+    def register(self, obj):
+        """Put `obj` in the identity map, unless an object with the same
+        key already is. Returns the one to use."""
+        existing = self.identity_map.setdefault((obj.bucket_name, obj.key),
+                                                obj)
+        if type(existing) is type(obj):
+            return existing
+        return obj
+
+    def discard(self, obj):
+        if self.identity_map.get((obj.bucket_name, obj.key)) is obj:
+            del self.identity_map[(obj.bucket_name, obj.key)]
+
+    def add(self, obj):
+        """Save `obj` on flush(), even though it wasn't loaded from
+        Riak."""
+        if obj.key is not None:
+            self.register(obj)
+        if obj._riak_obj is None and not any(o is obj for o in self.new):
+            self.new.append(obj)
+
+    def fetch_many(self, cls, keys, quorum=None):
+        """Like cls._fetch_many(), except that objects already in the
+        session take the place of the Riak objects."""
+        known = [self.lookup(cls, key) for key in keys]
+        missing = [key for key, obj in zip(keys, known) if obj is None]
+        return _Merged(known, cls._fetch_from_riak(missing, quorum))
+
+    def dirty(self):
+        """The objects flush() would save."""
+        retval = list(self.new)
+        seen = set(id(obj) for obj in retval)
+        for obj in self.identity_map.values():
+            # Skip new objects nobody add()ed and ones we already have
+            if ((obj._riak_obj is None and obj._deferred is None) or
+                    id(obj) in seen):
+                continue
+            if obj._resolved or obj.changed_fields():
+                retval += [obj]
+        return retval
+
+    def flush(self):
+        """Save all dirty objects, batched per model. Raises FlushError
+        if any of them failed."""
+        by_class = {}
+        for obj in self.dirty():
+            by_class.setdefault(type(obj), []).append(obj)
+        failed = []
+        for cls, objs in by_class.iteritems():
+            result = cls.save_many(objs)
+            failed += result.failed
+            # save_many() stores from other threads, so register the new
+            # keys here
+            for obj in result.succeeded:
+                self.register(obj)
+        failed_ids = set(id(obj) for obj, error in failed)
+        self.new = [obj for obj in self.new if id(obj) in failed_ids]
+        if failed:
+            raise FlushError(failed)
+
+
+def session(flush_on_exit=True):
+    """Start a session: `with riakalchemy.session(): ...`"""
+    return Session(flush_on_exit)
@@ -4,7 +4,10 @@ import unittest2 as unittest
 import riakalchemy
 from riakalchemy import RiakObject
 from riakalchemy.exceptions import ValidationError, NoSuchObjectError
-from riakalchemy.types import String, Integer, RelatedObjects
+from riakalchemy import codecs
+from riakalchemy import instrumentation
+from riakalchemy.types import String, Integer, Dict, RelatedObjects
+from riakalchemy.cache import LRUCache
 
 system_riak = os.environ.get('RIAKALCHEMY_SYSTEM_RIAK_PORT', '')
 
@@ -102,6 +105,79 @@ class _BasicTests(unittest.TestCase):
         obj = cls.get(obj.key)
         self._verify_values(obj, values)
 
+    def test_get_many(self):
+        """Fetch several objects by key, reporting the missing ones"""
+        cls = self._create_class()
+        objs = []
+        for age in range(5):
+            obj = cls(first_name='soren', age=age)
+            obj.save()
+            self.addCleanup(obj.delete)
+            objs += [obj]
+
+        missing = []
+        keys = [obj.key for obj in objs] + ['no-such-key']
+        results = cls.get_many(reversed(keys), missing=missing)
+        self.assertEquals([obj.age for obj in results], [4, 3, 2, 1, 0])
+        self.assertEquals(missing, ['no-such-key'])
+
+    def test_cached_get(self):
+        """get(key) is served from the cache until the object changes"""
+        cls = self._create_class()
+        cls.cache = LRUCache()
+        obj = cls(first_name='soren', age=31)
+        obj.save()
+        self.addCleanup(obj.delete)
+
+        self.assertEquals(cls.get(obj.key).age, 31)
+        self.assertEquals(cls.get(obj.key).age, 31)
+        self.assertEquals(cls.cache.stats()['hits'], 1)
+
+        obj.age = 32
+        obj.save()
+        self.assertEquals(cls.get(obj.key).age, 32)
+
+        obj_key = obj.key
+        obj.delete()
+        self.assertRaises(NoSuchObjectError, cls.get, obj_key)
+
+    def test_save_and_delete_many(self):
+        """Bulk save and delete report failures per object"""
+        cls = self._create_class()
+        objs = [cls(first_name='soren', age=age) for age in range(5)]
+        objs[2].age = 'this is not a number'
+        result = cls.save_many(objs)
+        self.assertFalse(result.ok)
+        self.assertEquals(len(result.succeeded), 4)
+        self.assertEquals(len(result.failed), 1)
+        self.assertIs(result.failed[0][0], objs[2])
+        self.assertIsInstance(result.failed[0][1], ValidationError)
+
+        saved = result.succeeded
+        self.assertEquals(len(cls.get_many(obj.key for obj in saved)), 4)
+
+        result = cls.delete_many(saved)
+        self.assertTrue(result.ok)
+        self.assertEquals(cls.get_many(obj.key for obj in saved), [])
+
+    def test_non_blocking_calls(self):
+        """aget/asave/adelete return futures"""
+        values = self._incomplete_value_set()
+        cls, obj = self._set_values_on_init(values)
+        future = obj.asave()
+        self.assertEquals(future.result(), None)
+        self.addCleanup(obj.delete)
+        self.assertTrue(future.done())
+
+        fetched = cls.aget(obj.key).result()
+        self._verify_values(fetched, values)
+        self.assertRaises(NoSuchObjectError,
+                          cls.aget('no-such-key').result)
+
+        obj_key = obj.key
+        fetched.adelete().result()
+        self.assertEquals(cls.aget_many([obj_key]).result(), [])
+
     def test_save_delete_retrieve_failes(self):
         """Create object, delete it, attempt to retrieve it again by key"""
         values = self._incomplete_value_set()
@@ -150,6 +226,15 @@ class _BasicTests(unittest.TestCase):
     def test_retrieve_by_values_non_searchable(self):
         self._test_retrieve_by_values(searchable=False)
 
+    def test_retrieve_by_quoted_value_non_searchable(self):
+        cls, obj = self._set_values_on_init({'first_name': 'O"Neil'})
+        obj.save()
+        self.addCleanup(obj.delete)
+
+        results = cls.get(first_name='O"Neil').all()
+        self.assertEquals(len(results), 1)
+        self.assertEquals(results[0].first_name, 'O"Neil')
+
     def test_relation(self):
         class Person9(RiakObject):
             bucket_name = 'users9'
@@ -257,6 +342,392 @@ class _BasicTests(unittest.TestCase):
         self.assertIn(persons[1].first_name, [persons[0].first_name,
                                               persons[1].first_name])
 
+    def test_iterate_query(self):
+        """Iterate over query results in batches"""
+        class Person12(RiakObject):
+            bucket_name = 'users12'
+
+            first_name = String(required=True)
+            manager = RelatedObjects(backref=True)
+
+        boss = Person12(first_name='jane')
+        boss.save()
+        self.addCleanup(boss.delete)
+        names = set()
+        for i in range(5):
+            user = Person12(first_name='user%d' % (i,), manager=[boss])
+            user.save()
+            self.addCleanup(user.delete)
+            names.add(user.first_name)
+
+        batches = list(Person12.get(manager=boss).iter_batches(2))
+        self.assertEquals([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEquals(set(p.first_name for batch in batches
+                                           for p in batch), names)
+        self.assertEquals(set(p.first_name
+                              for p in Person12.get(manager=boss)), names)
+        self.assertIn(Person12.get(manager=boss).first().first_name, names)
+        self.assertEquals(Person12.get(manager=user).first(), None)
+
+    def test_prefetch_relation(self):
+        """Relations can be loaded for a whole result set up front"""
+        class Person13(RiakObject):
+            bucket_name = 'users13'
+
+            first_name = String(required=True)
+            manager = RelatedObjects(backref=True)
+
+        boss = Person13(first_name='jane')
+        boss.save()
+        self.addCleanup(boss.delete)
+        for i in range(3):
+            user = Person13(first_name='user%d' % (i,), manager=[boss])
+            user.save()
+            self.addCleanup(user.delete)
+
+        users = Person13.get(manager=boss).prefetch('manager').all()
+        self.assertEquals(len(users), 3)
+        for user in users:
+            self.assertTrue(user._is_set('manager'))
+            self.assertEquals([m.first_name for m in user.manager], ['jane'])
+
+    def test_bucket_properties(self):
+        """Bucket properties declared on the model are applied on save"""
+        class Person14(RiakObject):
+            bucket_name = 'users14'
+            bucket_properties = {'last_write_wins': True}
+
+            first_name = String()
+
+        user = Person14(first_name='jane')
+        user.save()
+        self.addCleanup(user.delete)
+        bucket = riakalchemy.model.client.bucket('users14')
+        self.assertTrue(bucket.get_property('last_write_wins'))
+
+    def test_changed_fields(self):
+        """Changes are tracked from load() until the next save()"""
+        values = self._incomplete_value_set()
+        cls, obj = self._set_values_on_init(values)
+        self.assertEquals(obj.changed_fields(), set(['first_name', 'age']))
+        obj.save()
+        self.addCleanup(obj.delete)
+        self.assertEquals(obj.changed_fields(), set())
+
+        obj = cls.get(obj.key)
+        self.assertEquals(obj.changed_fields(), set())
+        obj.age = 32
+        self.assertEquals(obj.changed_fields(), set(['age']))
+        obj.save()
+        self.assertEquals(obj.changed_fields(), set())
+        self.assertEquals(cls.get(obj.key).age, 32)
+
+    def test_changed_dict(self):
+        """Changes inside Dict fields are tracked without copying them
+        on load"""
+        class Person27(RiakObject):
+            bucket_name = 'users27'
+
+            profile = Dict()
+
+        obj = Person27(profile={'tags': ['a']})
+        obj.save()
+        self.addCleanup(obj.delete)
+
+        obj = Person27.get(obj.key)
+        self.assertEquals(obj._saved_data, None)
+        obj.profile['tags'].append('b')
+        self.assertEquals(obj.changed_fields(), set(['profile']))
+        obj.save()
+        self.assertEquals(obj.changed_fields(), set())
+        self.assertEquals(Person27.get(obj.key).profile, {'tags': ['a', 'b']})
+        obj.profile['bio'] = 'x'
+        self.assertEquals(obj.changed_fields(), set(['profile']))
+
+    def test_changed_relation(self):
+        """Only relations that change get their links and indexes
+        rewritten"""
+        class Person15(RiakObject):
+            bucket_name = 'users15'
+
+            first_name = String(required=True)
+            manager = RelatedObjects(backref=True)
+
+        user1 = Person15(first_name='jane')
+        user1.save()
+        self.addCleanup(user1.delete)
+        user2 = Person15(first_name='john', manager=[user1])
+        user2.save()
+        self.addCleanup(user2.delete)
+
+        user2 = Person15.get(user2.key)
+        self.assertEquals(user2.changed_fields(), set())
+        self.assertEquals(user2.manager[0].first_name, 'jane')
+        self.assertEquals(user2.changed_fields(), set())
+        user2.first_name = 'johnny'
+        user2.save()
+        self.assertEquals(len(Person15.get(manager=user1).all()), 1)
+
+        user2.manager.remove(user2.manager[0])
+        self.assertEquals(user2.changed_fields(), set(['manager']))
+        user2.save()
+        self.assertEquals(Person15.get(manager=user1).all(), [])
+        self.assertEquals(Person15.get(user2.key).manager, [])
+
+    def test_indexed_fields(self):
+        """Lookups on indexed fields use secondary indexes"""
+        class Person16(RiakObject):
+            bucket_name = 'users16'
+
+            first_name = String(index=True)
+            last_name = String()
+            age = Integer(index=True)
+
+        for first_name, age in [('jane', 29), ('john', 30), ('jane', 31)]:
+            user = Person16(first_name=first_name, last_name='smith',
+                            age=age)
+            user.save()
+            self.addCleanup(user.delete)
+
+        ages = lambda query: sorted(user.age for user in query.all())
+        self.assertEquals(ages(Person16.get(age=30)), [30])
+        self.assertEquals(ages(Person16.get(age='30')), [30])
+        self.assertEquals(ages(Person16.get(age__gte=30)), [30, 31])
+        self.assertEquals(ages(Person16.get(age__lt=31)), [29, 30])
+        self.assertEquals(ages(Person16.get(age__range=(29, 30))), [29, 30])
+        self.assertEquals(ages(Person16.get(first_name='jane')), [29, 31])
+        self.assertEquals(ages(Person16.get(first_name='jane',
+                                            age__gte=30)), [31])
+        self.assertRaises(ValidationError, Person16.get,
+                          last_name__gte='smith')
+
+        # Indexes and other fields mixed: the index feeds MapReduce
+        self.assertEquals(ages(Person16.get(age__gte=30, last_name='smith')),
+                          [30, 31])
+        self.assertEquals(ages(Person16.get(age__gte=30, last_name='doe')),
+                          [])
+        self.assertEquals(ages(Person16.get(first_name='jane', age=31,
+                                            last_name='smith')), [31])
+        self.assertRaisesRegexp(ValidationError, '^last_name__gte ',
+                                Person16.get, age__gte=30,
+                                last_name__gte='smith')
+        self.assertRaises(ValidationError, Person16.get, age__gte=30,
+                          age__lt=40, last_name='smith')
+
+        user.age = 40
+        user.save()
+        self.assertEquals(ages(Person16.get(age__gte=30)), [30, 40])
+
+        # String ranges, with values as they come back from JSON
+        for first_name in [u'j\xf8rgen', u'\u4e2d']:
+            user = Person16(first_name=first_name, last_name='smith', age=50)
+            user.save()
+            self.addCleanup(user.delete)
+        names = lambda query: sorted(user.first_name for user in query.all())
+        self.assertEquals(names(Person16.get(first_name__gte='jo')),
+                          [u'john', u'j\xf8rgen', u'\u4e2d'])
+        self.assertEquals(names(Person16.get(first_name__gte=u'j\xf8')),
+                          [u'j\xf8rgen', u'\u4e2d'])
+        self.assertEquals(names(Person16.get(first_name__lte='jane')),
+                          ['jane', 'jane'])
+
+    def test_codecs(self):
+        """Objects are stored with their model's codec and can be read
+        back by models using another one"""
+        class Person17(RiakObject):
+            bucket_name = 'users17'
+            codec = codecs.JSONCodec(compress_threshold=100)
+
+            first_name = String()
+            profile = Dict()
+
+        class PlainPerson17(RiakObject):
+            bucket_name = 'users17'
+
+            first_name = String()
+            profile = Dict()
+
+        profile = {'bio': 'x' * 1000, 'tags': ['a', 'b']}
+        user = Person17(first_name='jane', profile=profile)
+        user.save()
+        self.addCleanup(user.delete)
+        self.assertEquals(Person17.get(user.key).profile, profile)
+        self.assertEquals(PlainPerson17.get(user.key).profile, profile)
+
+        other = PlainPerson17(first_name='john', profile=profile)
+        other.save()
+        self.addCleanup(other.delete)
+        self.assertEquals(Person17.get(other.key).profile, profile)
+
+    def test_projection(self):
+        """Queries can load only some fields up front"""
+        class Person18(RiakObject):
+            bucket_name = 'users18'
+
+            first_name = String()
+            last_name = String()
+            age = Integer(index=True)
+            profile = Dict()
+            manager = RelatedObjects()
+
+        boss = Person18(first_name='jane', last_name='doe', age=50)
+        boss.save()
+        self.addCleanup(boss.delete)
+        for i in range(3):
+            user = Person18(first_name='user%d' % (i,), last_name='smith',
+                            age=30 + i, profile={'bio': 'x' * 100},
+                            manager=[boss])
+            user.save()
+            self.addCleanup(user.delete)
+
+        # MapReduce: projected on the server
+        users = Person18.get(last_name='smith').only('first_name').all()
+        self.assertEquals(len(users), 3)
+        user = sorted(users, key=lambda u: u.first_name)[0]
+        self.assertEquals(user.first_name, 'user0')
+        self.assertFalse(user._is_set('age'))
+        self.assertEquals(user.changed_fields(), set())
+        self.assertEquals(user.age, 30)
+        self.assertEquals(user.manager[0].first_name, 'jane')
+        user.first_name = 'johnny'
+        user.save()
+        stored = Person18.get(user.key)
+        self.assertEquals((stored.first_name, stored.age, stored.profile),
+                          ('johnny', 30, {'bio': 'x' * 100}))
+
+        # Fetched objects: decoded lazily
+        users = list(Person18.get(age__gte=30).defer('profile'))
+        self.assertEquals(len(users), 4)
+        for user in users:
+            self.assertTrue(user._is_set('age'))
+            self.assertFalse(user._is_set('profile'))
+        user = [u for u in users if u.age == 31][0]
+        user.age = 41
+        user.save()
+        stored = Person18.get(user.key)
+        self.assertEquals((stored.age, stored.profile),
+                          (41, {'bio': 'x' * 100}))
+        self.assertEquals(user.profile, {'bio': 'x' * 100})
+        self.assertRaises(AttributeError,
+                          Person18.get(age=41).only, 'nickname')
+        self.assertRaises(AttributeError,
+                          Person18.get(age=41).defer, 'manager')
+
+        # Projected objects are fetched in one batch for prefetch()
+        instrumentation.enable()
+        self.addCleanup(instrumentation.stats.reset)
+        self.addCleanup(instrumentation.disable)
+        users = (Person18.get(last_name='smith').only('first_name')
+                         .prefetch('manager').all())
+        stats = instrumentation.snapshot()
+        self.assertEquals(stats[('query', 'Person18', 'users18')]
+                               ['round_trips'], 5)
+        self.assertEquals([user.manager[0].first_name for user in users],
+                          ['jane'] * 3)
+        self.assertEquals(instrumentation.snapshot(), stats)
+
+    def test_aggregations(self):
+        """Queries can be counted, summed and grouped by Riak"""
+        class Person19(RiakObject):
+            bucket_name = 'users19'
+
+            first_name = String()
+            last_name = String(index=True)
+            city = String()
+            age = Integer(index=True)
+
+        for first_name, city, age in [('jane', 'aarhus', 29),
+                                      ('john', 'aarhus', 30),
+                                      ('jim', 'odense', 31),
+                                      ('joe', None, 40)]:
+            user = Person19(first_name=first_name, last_name='smith',
+                            age=age)
+            if city:
+                user.city = city
+            user.save()
+            self.addCleanup(user.delete)
+
+        for query in [lambda: Person19.get_mr(last_name='smith'),
+                      lambda: Person19.get(age__gte=0),
+                      lambda: Person19.get(age__gte=0, last_name='smith')]:
+            self.assertEquals(query().count(), 4)
+            self.assertEquals(query().sum('age'), 130)
+            self.assertEquals(sorted(query().values_list('city')),
+                              ['aarhus', 'aarhus', 'odense'])
+            self.assertEquals(query().group_by('city').count(),
+                              {'aarhus': 2, 'odense': 1, None: 1})
+            self.assertEquals(query().group_by('city').sum('age'),
+                              {'aarhus': 59, 'odense': 31, None: 40})
+        self.assertEquals(Person19.get_mr(first_name='nobody').count(), 0)
+        self.assertEquals(Person19.get_mr(first_name='nobody').sum('age'),
+                          0)
+        self.assertRaises(AttributeError,
+                          Person19.get_mr(first_name='jim').sum, 'height')
+
+    def test_exists_and_keys(self):
+        """Existence checks and key-only queries don't fetch objects"""
+        class Person24(RiakObject):
+            bucket_name = 'users24'
+
+            first_name = String()
+            age = Integer(index=True)
+
+        people = [Person24(first_name='p%d' % (i,), age=i) for i in range(5)]
+        for person in people:
+            person.save()
+            self.addCleanup(person.delete)
+
+        self.assertTrue(Person24.exists(people[0].key))
+        self.assertFalse(Person24.exists('nonexistant'))
+        self.assertEquals(Person24.exists_many([people[1].key, 'nonexistant',
+                                                people[2].key]),
+                          [True, False, True])
+
+        expected = sorted(person.key for person in people[2:])
+        self.assertEquals(sorted(Person24.get(age__gte=2).keys()), expected)
+        self.assertEquals(sorted(Person24.get(age__gte=2).iter_keys(2)),
+                          expected)
+        self.assertEquals(sorted(Person24.get_mr(first_name='p3').keys()),
+                          [people[3].key])
+
+    def test_session(self):
+        """Sessions load every object once and save changes in one go"""
+        class Person21(RiakObject):
+            bucket_name = 'users21'
+
+            first_name = String()
+            age = Integer(index=True)
+            manager = RelatedObjects()
+
+        boss = Person21(first_name='jane', age=50)
+        boss.save()
+        self.addCleanup(boss.delete)
+        user = Person21(first_name='john', age=30, manager=[boss])
+        user.save()
+        self.addCleanup(user.delete)
+
+        with riakalchemy.session() as session:
+            boss1 = Person21.get(boss.key)
+            self.assertIs(Person21.get(boss.key), boss1)
+            user1 = Person21.get(user.key)
+            self.assertIs(user1.manager[0], boss1)
+            self.assertIs(Person21.get_many([user.key, boss.key])[1], boss1)
+            self.assertIn(boss1, Person21.get(age__gte=40).all())
+            self.assertIs(Person21.get(age__gte=40).first(), boss1)
+
+            boss1.age = 51
+            new = Person21(first_name='jim', age=20)
+            session.add(new)
+            self.assertEquals(len(session.dirty()), 2)
+        self.addCleanup(new.delete)
+
+        self.assertNotEquals(new.key, None)
+        self.assertEquals(Person21.get(boss.key).age, 51)
+        self.assertEquals(Person21.get(new.key).first_name, 'jim')
+
+        with riakalchemy.session():
+            self.assertIsNot(Person21.get(boss.key), boss1)
+
 
 class RiakBackedTests(_BasicTests):
     test_server_started = False
@@ -271,3 +742,220 @@ class RiakBackedTests(_BasicTests):
                 riakalchemy.model._clear_test_connection()
         else:
             riakalchemy.connect(test_server=False, port=riak_port)
+
+
+class MemoryBackedTests(_BasicTests):
+    def setUp(self):
+        riakalchemy.use_memory_backend()
+        self.addCleanup(riakalchemy.use_real_backend)
+        riakalchemy.connect()
+
+    def test_memory_backend(self):
+        """use_memory_backend() makes connect() use a MemoryClient"""
+        self.assertIsInstance(riakalchemy.model.client,
+                              riakalchemy.memory.MemoryClient)
+        riakalchemy.use_real_backend()
+        self.assertIs(riakalchemy.connect, riakalchemy.model.connect)
+
+    def test_instrumentation(self):
+        """Relation traversal round trips are reported"""
+        class Person20(RiakObject):
+            bucket_name = 'users20'
+
+            first_name = String()
+            friends = RelatedObjects()
+
+        friends = [Person20(first_name='friend%d' % (i,)) for i in range(3)]
+        for friend in friends:
+            friend.save()
+        person = Person20(first_name='jane', friends=friends)
+        person.save()
+
+        instrumentation.enable()
+        self.addCleanup(instrumentation.stats.reset)
+        self.addCleanup(instrumentation.disable)
+        client = riakalchemy.model.client
+        round_trips = client.round_trips
+        Person20.get(person.key).friends
+        stats = instrumentation.snapshot()
+        self.assertEquals(stats[('get', 'Person20', 'users20')]
+                               ['round_trips'], 1)
+        self.assertEquals(stats[('traverse', 'Person20', 'users20')]
+                               ['round_trips'], 3)
+        self.assertEquals(client.round_trips - round_trips, 4)
+
+    def test_quorum(self):
+        """Quorum options come from the model, can be overridden per call
+        and only go to the requests that take them"""
+        class Person22(RiakObject):
+            bucket_name = 'users22'
+            quorum = {'r': 1, 'w': 2}
+
+            first_name = String()
+            age = Integer(index=True)
+
+        calls = []
+
+        def spy(cls, name):
+            method = getattr(cls, name)
+
+            def wrapper(*args, **kwargs):
+                calls.append((name, kwargs))
+                return method(*args, **kwargs)
+            setattr(cls, name, wrapper)
+            self.addCleanup(setattr, cls, name, method)
+        spy(riakalchemy.memory.MemoryBucket, 'get')
+        spy(riakalchemy.memory.MemoryClient, 'put')
+        spy(riakalchemy.memory.MemoryClient, 'delete')
+
+        person = Person22(first_name='john', age=30)
+        person.save(quorum={'dw': 2})
+        self.assertEquals(calls.pop(), ('put', {'w': 2, 'dw': 2}))
+        Person22.get(person.key)
+        self.assertEquals(calls.pop(), ('get', {'r': 1}))
+        Person22.get(person.key, quorum={'r': 'all', 'pr': 1})
+        self.assertEquals(calls.pop(), ('get', {'r': 'all', 'pr': 1}))
+        Person22.get_many([person.key], quorum={'r': 3})
+        self.assertEquals(calls.pop(), ('get', {'r': 3}))
+        Person22.get(age=30).all(quorum={'r': 2})
+        self.assertEquals(calls.pop(), ('get', {'r': 2}))
+        Person22.save_many([Person22(first_name='jim')], quorum={'w': 3})
+        self.assertEquals(calls.pop(), ('put', {'w': 3}))
+        person.delete(quorum={'pw': 1})
+        self.assertEquals(calls.pop(), ('delete', {'r': 1, 'w': 2, 'pw': 1}))
+
+        self.assertRaises(ValueError, Person22.get, 'foo',
+                          quorum={'x': 1})
+        self.assertRaises(ValueError, Person22.get, 'foo',
+                          quorum={'basic_quorum': True})
+
+    def test_key_only_requests(self):
+        class Person24(RiakObject):
+            bucket_name = 'users24'
+
+            first_name = String()
+            age = Integer(index=True)
+
+        person = Person24(first_name='john', age=30)
+        person.save()
+        client = riakalchemy.model.client
+        fetches = []
+        get = riakalchemy.memory.MemoryClient._get
+        self.addCleanup(setattr, riakalchemy.memory.MemoryClient, '_get',
+                        get)
+        riakalchemy.memory.MemoryClient._get = (
+            lambda self, *args: fetches.append(args) or get(self, *args))
+
+        round_trips = client.round_trips
+        self.assertTrue(Person24.exists(person.key))
+        self.assertEquals(Person24.get(age=30).keys(), [person.key])
+        self.assertEquals(list(Person24.get_mr(age=30).iter_keys()),
+                          [person.key])
+        self.assertEquals(fetches, [])
+        self.assertEquals(client.round_trips - round_trips, 3)
+
+        with riakalchemy.session():
+            Person24.get(person.key)
+            round_trips = client.round_trips
+            self.assertEquals(Person24.exists_many([person.key]), [True])
+            self.assertEquals(client.round_trips, round_trips)
+
+    def test_search_query_syntax(self):
+        Person = self._create_class(searchable=True)
+        Person(first_name='Alice', last_name='Smith').save()
+        Person(first_name='Bob', last_name='Smith').save()
+        Person(first_name='Carol', last_name='Jones').save()
+
+        def names(query):
+            keys = [key for bucket, key in
+                    riakalchemy.model.client.search('users1', query).run()]
+            return sorted(Person.get(key).first_name for key in keys)
+
+        self.assertEquals(names('last_name:Smith AND NOT first_name:Bob'),
+                          ['Alice'])
+        self.assertEquals(names('first_name:Bob OR last_name:"Jones"'),
+                          ['Bob', 'Carol'])
+        self.assertEquals(names('first_name:?o* (last_name:Jones)'),
+                          [])
+        self.assertEquals(names('(first_name:A* OR first_name:C*) '
+                                'last_name:J*'), ['Carol'])
+        self.assertEquals(names('first_name:[Alice TO Bob]'),
+                          ['Alice', 'Bob'])
+        self.assertEquals(names('first_name:{Alice TO *}'),
+                          ['Bob', 'Carol'])
+        self.assertEquals(names('first_name:Al\\ice'), ['Alice'])
+
+    def test_search_api(self):
+        """Search lookups, paging and sorting; fields in the search
+        documents are used without fetching the objects"""
+        class Person23(RiakObject):
+            searchable = True
+            bucket_name = 'users23'
+
+            first_name = String()
+            last_name = String()
+            age = Integer()
+            profile = Dict()
+
+        for i, name in enumerate(['Alice', 'Bob', 'Carol', 'Dave']):
+            Person23(first_name=name, last_name='Smith', age=20 + i,
+                     profile={'i': i}).save()
+
+        def names(query):
+            return [p.first_name for p in query.all()]
+
+        self.assertEquals(sorted(names(Person23.get(age__gte=22))),
+                          ['Carol', 'Dave'])
+        self.assertEquals(sorted(names(Person23.get(age__range=(21, 22)))),
+                          ['Bob', 'Carol'])
+        self.assertEquals(sorted(names(Person23.get(
+                              first_name__in=['Bob', 'Dave']))),
+                          ['Bob', 'Dave'])
+        self.assertEquals(sorted(names(Person23.get_search(
+                              'first_name:A* OR first_name:D*',
+                              last_name='Smith'))),
+                          ['Alice', 'Dave'])
+        self.assertEquals(names(Person23.get_search(last_name='Smith')
+                                        .order_by('-age').limit(2, 1)),
+                          ['Carol', 'Bob'])
+        self.assertEquals(Person23.get(first_name__startswith='C')
+                                  .first().age, 22)
+        self.assertRaises(ValueError,
+                          Person23.get_mr(last_name='Smith').limit, 1)
+
+        client = riakalchemy.model.client
+        round_trips = client.round_trips
+        people = (Person23.get_search(last_name='Smith')
+                          .only('first_name', 'age').order_by('age').all())
+        self.assertEquals(client.round_trips - round_trips, 1)
+        self.assertEquals([(p.first_name, p.age) for p in people],
+                          [('Alice', 20), ('Bob', 21), ('Carol', 22),
+                           ('Dave', 23)])
+        self.assertEquals(people[3].profile, {'i': 3})
+
+    def test_paginated_index(self):
+        class Person(RiakObject):
+            bucket_name = 'users1'
+
+            first_name = String()
+            age = Integer(index=True)
+
+        for age in range(5):
+            Person(first_name='p%d' % (age,), age=age).save()
+        bucket = riakalchemy.model.client.bucket('users1')
+        page = bucket.get_index('age_int', 1, 4, max_results=2)
+        self.assertEquals(len(page.results), 2)
+        rest = bucket.get_index('age_int', 1, 4, max_results=2,
+                                continuation=page.continuation)
+        self.assertEquals(len(rest.results), 2)
+        self.assertEquals(rest.continuation, None)
+        self.assertEquals(len(bucket.get_keys()), 5)
+
+    def test_delete_is_immediate(self):
+        Person, person = self._create_object(first_name='Soren')
+        person.save()
+        key = person.key
+        person.delete()
+        self.assertEquals(riakalchemy.model.client.bucket('users1').get_keys(),
+                          [])
+        self.assertRaises(NoSuchObjectError, Person.get, key)
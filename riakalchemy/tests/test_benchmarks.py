@@ -0,0 +1,16 @@
+import unittest2 as unittest
+
+from riakalchemy import benchmarks
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_run(self):
+        """The benchmarks run against the in-memory stand-in"""
+        results = benchmarks.run(number=5, repeat=1, links=2)
+        names = [result['name'] for result in results]
+        self.assertIn('get', names)
+        self.assertIn('relation_traversal', names)
+        for result in results:
+            self.assertTrue(result['best_us'] >= 0)
+        get = [result for result in results if result['name'] == 'get'][0]
+        self.assertEquals(get['round_trips_per_call'], 1)
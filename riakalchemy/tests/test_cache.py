@@ -0,0 +1,70 @@
+import time
+import unittest2 as unittest
+
+from riakalchemy.cache import LRUCache, MemcacheCache
+
+
+class _FakeMemcache(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl=0):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertEquals(cache.get('a'), None)
+        cache.set('a', {'x': 1})
+        self.assertEquals(cache.get('a'), {'x': 1})
+        self.assertEquals(cache.stats()['hits'], 1)
+        self.assertEquals(cache.stats()['misses'], 1)
+
+    def test_values_are_copied(self):
+        cache = LRUCache()
+        value = {'x': [1]}
+        cache.set('a', value)
+        value['x'] += [2]
+        cache.get('a')['x'] += [3]
+        self.assertEquals(cache.get('a'), {'x': [1]})
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertEquals(cache.get('a'), None)
+
+    def test_delete(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.delete('a')
+        self.assertEquals(cache.get('a'), None)
+
+
+class MemcacheCacheTests(unittest.TestCase):
+    def test_get_set_delete(self):
+        cache = MemcacheCache(_FakeMemcache())
+        cache.set('a', {'x': 1})
+        self.assertEquals(cache.get('a'), {'x': 1})
+        cache.delete('a')
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.stats()['hits'], 1)
+        self.assertEquals(cache.stats()['misses'], 1)
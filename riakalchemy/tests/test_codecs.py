@@ -0,0 +1,64 @@
+import json
+import unittest2 as unittest
+
+from riakalchemy import codecs
+
+
+class JSONCodecTests(unittest.TestCase):
+    def test_round_trip(self):
+        codec = codecs.JSONCodec()
+        data = {'name': 'jane', 'age': 30, 'profile': {'bio': 'x' * 100}}
+        self.assertEquals(codec.decode(codec.encode(data)), data)
+
+    def test_large_dicts_are_compressed(self):
+        codec = codecs.JSONCodec(compress_threshold=50)
+        data = {'name': 'jane', 'small': {'a': 1},
+                'profile': {'bio': 'x' * 1000}}
+        payload = codec.encode(data)
+        self.assertLess(len(payload), 200)
+        stored = json.loads(payload)
+        self.assertEquals(stored['name'], 'jane')
+        self.assertEquals(stored['small'], {'a': 1})
+        self.assertEquals(stored['profile'].keys(), ['__zlib__'])
+        self.assertEquals(codec.decode(payload), data)
+
+    def test_floats_are_exact(self):
+        codec = codecs.JSONCodec()
+        data = {'ratio': 1 / 3.0, 'sum': 0.1 + 0.2, 'big': 1e300 / 7}
+        self.assertEquals(codec.decode(codec.encode(data)), data)
+
+    def test_fast_needs_ujson(self):
+        if codecs.ujson is not None:
+            self.skipTest('ujson is installed')
+        self.assertRaises(ImportError, codecs.JSONCodec, fast=True)
+
+    def test_fast_round_trip(self):
+        if codecs.ujson is None:
+            self.skipTest('ujson is not installed')
+        codec = codecs.JSONCodec(compress_threshold=50, fast=True)
+        data = {'name': 'jane', 'age': 30.5, 'profile': {'bio': 'x' * 1000}}
+        self.assertEquals(codec.decode(codec.encode(data)), data)
+
+    def test_reads_plain_json(self):
+        codec = codecs.JSONCodec(compress_threshold=50)
+        data = {'name': 'jane', 'profile': {'bio': 'x' * 1000}}
+        self.assertEquals(codec.decode(json.dumps(data)), data)
+
+
+class MsgpackCodecTests(unittest.TestCase):
+    def setUp(self):
+        if codecs.msgpack is None:
+            self.skipTest('msgpack is not installed')
+
+    def test_round_trip(self):
+        codec = codecs.MsgpackCodec(compress_threshold=50)
+        data = {'name': 'jane', 'profile': {'bio': 'x' * 1000}}
+        self.assertEquals(codec.decode(codec.encode(data)), data)
+
+
+class RegistryTests(unittest.TestCase):
+    def test_new_codecs_are_not_registered(self):
+        registered = codecs.get('application/json')
+        codecs.JSONCodec(compress_threshold=100)
+        self.assertIs(codecs.get('application/json'), registered)
+        self.assertIs(registered, codecs.default_codec)
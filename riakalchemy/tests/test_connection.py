@@ -0,0 +1,123 @@
+import threading
+import unittest2 as unittest
+
+from riakalchemy import codecs, memory, model, RiakObject
+from riakalchemy.connection import ConnectionPool, PooledClient
+from riakalchemy.types import String
+
+
+class _FakeClient(object):
+    def __init__(self, node):
+        self.node = node
+        self.decoders = {}
+
+    def set_encoder(self, content_type, encoder):
+        pass
+
+    def set_decoder(self, content_type, decoder):
+        self.decoders[content_type] = decoder
+
+
+class _TestPool(ConnectionPool):
+    down = ()
+
+    def _new_client(self, node):
+        return _FakeClient(node)
+
+    def _is_alive(self, client):
+        return client.node.host not in self.down
+
+
+class _MemoryPool(_TestPool):
+    """MemoryClients per thread, all looking at the same data"""
+
+    def __init__(self, nodes):
+        self.store = memory.MemoryClient()
+        self.clients = []
+        super(_MemoryPool, self).__init__(nodes)
+
+    def _new_client(self, node):
+        client = memory.MemoryClient()
+        client._buckets = self.store._buckets
+        client._lock = self.store._lock
+        client.node = node
+        self.clients.append(client)
+        return client
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def _clients_for_threads(self, pool, count):
+        clients = []
+
+        def run():
+            clients.append(pool.client())
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        return clients
+
+    def test_client_is_kept_per_thread(self):
+        pool = _TestPool(['a', 'b'])
+        self.assertIs(pool.client(), pool.client())
+
+    def test_round_robin(self):
+        pool = _TestPool(['a', 'b', 'c'])
+        clients = self._clients_for_threads(pool, 6)
+        self.assertEquals([c.node.host for c in clients],
+                          ['a', 'b', 'c', 'a', 'b', 'c'])
+
+    def test_least_loaded(self):
+        pool = _TestPool(['a', 'b'], strategy='least_loaded')
+        first = pool.client()
+        self.assertEquals(first.node.host, 'a')
+        clients = self._clients_for_threads(pool, 1)
+        self.assertEquals(clients[0].node.host, 'b')
+
+    def test_failing_node_is_ejected(self):
+        pool = _TestPool(['a', 'b'], check_interval=0)
+        pool.down = ('a',)
+        client = pool.client()
+        self.assertEquals(client.node.host, 'b')
+        self.assertTrue(pool.nodes[0].is_ejected())
+        self.assertFalse(pool.nodes[1].is_ejected())
+
+    def test_codecs_are_installed(self):
+        pool = _TestPool(['a'])
+        client = pool.client()
+        self.assertIn('application/json', client.decoders)
+        class TestCodec(codecs.JSONCodec):
+            content_type = 'application/x-test'
+        codecs.register(TestCodec())
+        self.addCleanup(codecs._codecs.pop, 'application/x-test')
+        self.assertIs(pool.client(), client)
+        self.assertIn('application/x-test', client.decoders)
+
+    def test_unknown_protocol_rejected(self):
+        self.assertRaises(ValueError, ConnectionPool, ['a'], protocol='udp')
+
+    def test_bulk_requests_use_worker_clients(self):
+        pool = _MemoryPool(['a', 'b'])
+        self.addCleanup(setattr, model, 'client', model.client)
+        model.client = PooledClient(pool)
+
+        class PooledPerson(RiakObject):
+            bucket_name = 'pooled'
+
+            name = String()
+
+        people = [PooledPerson(name='p%d' % (i,)) for i in range(8)]
+        self.assertTrue(PooledPerson.save_many(people, concurrency=4).ok)
+        keys = [person.key for person in people]
+        self.assertEquals(len(PooledPerson.get_many(keys)), 8)
+        self.assertEquals(PooledPerson.exists_many(keys), [True] * 8)
+        self.assertTrue(PooledPerson.delete_many(people, concurrency=4).ok)
+        self.assertEquals(pool.store._records('pooled'), {})
+
+        own = pool.client()
+        self.assertEquals(own.round_trips, 0)
+        self.assertEquals(sum(client.round_trips for client in pool.clients),
+                          32)
+        self.assertEquals(set(client.node.host for client in pool.clients),
+                          set(['a', 'b']))
@@ -0,0 +1,96 @@
+import logging
+import unittest2 as unittest
+
+from riakalchemy import instrumentation
+from riakalchemy.instrumentation import Event, instrumented
+
+
+class _Model(object):
+    bucket_name = 'things'
+
+    @classmethod
+    @instrumented('get')
+    def get(cls, fail=False):
+        instrumentation.round_trip()
+        cls().traverse()
+        if fail:
+            raise ValueError()
+
+    @instrumented('traverse')
+    def traverse(self):
+        instrumentation.round_trip(3)
+
+
+class _ListSink(object):
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+
+class _Socket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+class InstrumentationTests(unittest.TestCase):
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.stats.reset()
+
+    def test_disabled_by_default(self):
+        sink = _ListSink()
+        instrumentation.sinks.append(sink)
+        _Model.get()
+        self.assertEquals(sink.events, [])
+
+    def test_round_trips_include_nested_calls(self):
+        sink = _ListSink()
+        instrumentation.enable(sink)
+        _Model.get()
+        self.assertEquals([(e.operation, e.model, e.bucket, e.round_trips)
+                           for e in sink.events],
+                          [('traverse', '_Model', 'things', 3),
+                           ('get', '_Model', 'things', 4)])
+
+    def test_stats(self):
+        instrumentation.enable()
+        _Model.get()
+        self.assertRaises(ValueError, _Model.get, fail=True)
+        stats = instrumentation.snapshot()[('get', '_Model', 'things')]
+        self.assertEquals(stats['count'], 2)
+        self.assertEquals(stats['errors'], 1)
+        self.assertEquals(stats['round_trips'], 8)
+        self.assertEquals(stats['max_round_trips'], 4)
+        self.assertEquals(sum(stats['histogram'].values()), 2)
+
+    def test_statsd_names(self):
+        sink = instrumentation.StatsdSink(prefix='app')
+        sink._socket.close()
+        sink._socket = _Socket()
+        sink.record(Event('get', 'Person', 'users 1', 0.01, 1, False))
+        sink.record(Event('save', 'Person', None, 0.002, 3, True))
+        self.assertEquals(sink._socket.sent,
+                          [('app.users_1.get:10.000|ms\n'
+                            'app.users_1.get.round_trips:1|h',
+                            ('127.0.0.1', 8125)),
+                           ('app.Person.save:2.000|ms\n'
+                            'app.Person.save.round_trips:3|h\n'
+                            'app.Person.save.errors:1|c',
+                            ('127.0.0.1', 8125))])
+
+    def test_logging_sink(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('riakalchemy.test')
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        instrumentation.enable(instrumentation.LoggingSink(logger))
+        _Model.get()
+        self.assertEquals(len(records), 2)
+        self.assertIn('4 round trips', records[1].getMessage())
@@ -0,0 +1,17 @@
+import unittest2 as unittest
+
+from riakalchemy.model import MapReducePlan
+
+
+class MapReducePlanTests(unittest.TestCase):
+    def test_plans_are_cached_per_field_set(self):
+        plan = MapReducePlan.for_fields(['last_name', 'first_name'])
+        self.assertIs(plan, MapReducePlan.for_fields(['first_name',
+                                                      'last_name']))
+        self.assertIsNot(plan, MapReducePlan.for_fields(['first_name']))
+
+    def test_values_go_in_the_argument(self):
+        plan = MapReducePlan.for_fields(['first_name', 'age'])
+        values = {'first_name': 'O"Neil', 'age': 31}
+        self.assertEquals(plan.arg(values), [31, 'O"Neil'])
+        self.assertNotIn('Neil', plan.map_source)
@@ -0,0 +1,72 @@
+import logging
+import subprocess
+import sys
+import unittest2 as unittest
+
+from riakalchemy import RiakObject
+from riakalchemy import model as model_module
+from riakalchemy.exceptions import DuplicateBucketError
+from riakalchemy.model import RiakModelRegistry, _registry
+from riakalchemy.types import String
+
+
+def _define_model(bucket, **attrs):
+    attrs.update(bucket_name=bucket, name=String())
+    return type('RegistryPerson', (RiakObject,), attrs)
+
+
+class RegistryTests(unittest.TestCase):
+    def test_lookup_by_bucket_name(self):
+        model = _define_model('registry_lookup')
+        self.assertIs(_registry.class_by_bucket_name('registry_lookup'),
+                      model)
+        self.assertIs(RiakModelRegistry().class_by_bucket_name(
+                          'registry_lookup'), None)
+
+    def test_redefinition_replaces_model(self):
+        _define_model('registry_redefined')
+        model = _define_model('registry_redefined')
+        self.assertIs(_registry.class_by_bucket_name('registry_redefined'),
+                      model)
+
+    def test_duplicate_bucket_warns(self):
+        model = _define_model('registry_warned')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('riakalchemy')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        class OtherPerson(RiakObject):
+            bucket_name = 'registry_warned'
+        self.assertEquals([record.levelname for record in records],
+                          ['WARNING'])
+        self.assertIn('registry_warned', records[0].getMessage())
+        self.assertIs(_registry.class_by_bucket_name('registry_warned'),
+                      model)
+
+    def test_duplicate_bucket_rejected(self):
+        _define_model('registry_duplicate')
+        self.addCleanup(setattr, model_module, 'strict_buckets', False)
+        model_module.strict_buckets = True
+
+        def define():
+            class OtherPerson(RiakObject):
+                bucket_name = 'registry_duplicate'
+        self.assertRaises(DuplicateBucketError, define)
+
+    def test_shared_bucket(self):
+        model = _define_model('registry_shared')
+
+        class OtherPerson(RiakObject):
+            bucket_name = 'registry_shared'
+            shares_bucket = True
+        self.assertIs(_registry.class_by_bucket_name('registry_shared'),
+                      model)
+
+    def test_riak_is_imported_lazily(self):
+        imported = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, riakalchemy; '
+                                   'print("riak" in sys.modules)'])
+        self.assertEquals(imported.strip(), 'False')
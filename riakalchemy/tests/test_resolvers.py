@@ -0,0 +1,78 @@
+import unittest2 as unittest
+
+from riakalchemy import RiakObject
+from riakalchemy import resolvers
+from riakalchemy.types import String, Integer, RelatedObjects
+
+
+class _Sibling(object):
+    def __init__(self, data, last_modified, links=(), indexes=()):
+        self.data = data
+        self.last_modified = last_modified
+        self.links = list(links)
+        self.indexes = set(indexes)
+
+
+class _ConflictedObject(object):
+    key = 'conflicted'
+
+    def __init__(self, siblings):
+        self.siblings = siblings
+
+    @property
+    def data(self):
+        assert len(self.siblings) == 1
+        return self.siblings[0].data
+
+    @property
+    def links(self):
+        assert len(self.siblings) == 1
+        return self.siblings[0].links
+
+
+class ResolverTests(unittest.TestCase):
+    def _siblings(self):
+        return [_Sibling({'name': 'new', 'age': 30}, 200,
+                         links=[('people', 'a', 'friends')],
+                         indexes=[('friends_bin', 'people/a')]),
+                _Sibling({'name': 'old', 'city': 'Aarhus'}, 100,
+                         links=[('people', 'b', 'friends')],
+                         indexes=[('friends_bin', 'people/b'),
+                                  ('city_bin', 'Aarhus')])]
+
+    def test_last_modified_wins(self):
+        winner = resolvers.last_modified_wins(self._siblings())
+        self.assertEquals(winner.data, {'name': 'new', 'age': 30})
+
+    def test_merge_fields(self):
+        winner = resolvers.merge_fields(self._siblings())
+        self.assertEquals(winner.data,
+                          {'name': 'new', 'age': 30, 'city': 'Aarhus'})
+        self.assertEquals(winner.links, [('people', 'a', 'friends')])
+        self.assertEquals(winner.indexes,
+                          set([('friends_bin', 'people/a'),
+                               ('city_bin', 'Aarhus')]))
+
+    def test_union_relations(self):
+        winner = resolvers.union_relations(self._siblings())
+        self.assertEquals(winner.links, [('people', 'a', 'friends'),
+                                         ('people', 'b', 'friends')])
+        self.assertEquals(winner.indexes,
+                          set([('friends_bin', 'people/a'),
+                               ('friends_bin', 'people/b'),
+                               ('city_bin', 'Aarhus')]))
+
+    def test_model_resolver(self):
+        class Person(RiakObject):
+            bucket_name = 'resolver_people'
+            resolver = resolvers.merge_fields
+
+            name = String()
+            age = Integer()
+            city = String()
+            friends = RelatedObjects()
+
+        person = Person.load(_ConflictedObject(self._siblings()))
+        self.assertEquals(person.name, 'new')
+        self.assertEquals(person.city, 'Aarhus')
+        self.assertTrue(person._resolved)
@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest2 as unittest
+
+from riakalchemy import memory, workers
+from riakalchemy.exceptions import TimeoutError
+
+
+class WorkersTests(unittest.TestCase):
+    def test_map_ordered_keeps_order(self):
+        self.assertEquals(workers.map_ordered(lambda x: x * 2, range(20), 4),
+                          [x * 2 for x in range(20)])
+
+    def test_chunked(self):
+        self.assertEquals(list(workers.chunked(range(5), 2)),
+                          [[0, 1], [2, 3], [4]])
+
+    def test_attempt_retries(self):
+        calls = []
+
+        def flaky():
+            calls.append(None)
+            if len(calls) < 3:
+                raise IOError()
+
+        self.assertEquals(workers.attempt(flaky, retries=2), None)
+        self.assertEquals(len(calls), 3)
+
+    def test_attempt_gives_up(self):
+        def broken():
+            raise IOError('broken')
+
+        error = workers.attempt(broken, retries=1)
+        self.assertIsInstance(error, IOError)
+
+    def test_submit(self):
+        future = workers.submit(lambda x: x + 1, 41)
+        self.assertEquals(future.result(1), 42)
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEquals(done, [future])
+
+    def test_submit_exception(self):
+        def broken():
+            raise IOError('broken')
+
+        future = workers.submit(broken)
+        self.assertIsInstance(future.exception(1), IOError)
+        self.assertRaises(IOError, future.result)
+
+    def test_exception_timeout(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        future = workers.submit(slow)
+        self.addCleanup(release.set)
+        started.wait(1)
+        self.assertRaises(TimeoutError, future.exception, 0.01)
+        self.assertRaises(TimeoutError, future.result, 0.01)
+        release.set()
+        self.assertEquals(future.result(1), None)
+
+    def test_async_pool_size(self):
+        self.addCleanup(setattr, workers, 'async_concurrency',
+                        workers.async_concurrency)
+        memory.connect(async_pool_size=100)
+        self.assertEquals(workers.async_concurrency, 100)
+
+        # More calls than the default pool size can be in flight
+        running = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def wait():
+            running.append(None)
+            release.wait(5)
+
+        futures = [workers.submit_to(40, wait) for i in range(40)]
+        deadline = time.time() + 2
+        while len(running) < 40 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(len(running), 40)
+        release.set()
+        for future in futures:
+            future.result(1)
@@ -0,0 +1,132 @@
+import time
+import unittest2 as unittest
+
+import riakalchemy
+from riakalchemy import RiakObject
+from riakalchemy.exceptions import BufferFullError, ValidationError
+from riakalchemy.types import Integer, String
+from riakalchemy.writebehind import WriteBehindBuffer
+
+
+def _wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class WriteBehindTests(unittest.TestCase):
+    def setUp(self):
+        riakalchemy.use_memory_backend()
+        self.addCleanup(riakalchemy.use_real_backend)
+        riakalchemy.connect()
+        self.client = riakalchemy.model.client
+
+    def _create_class(self, **kwargs):
+        kwargs.setdefault('interval', 60)
+        buf = WriteBehindBuffer(**kwargs)
+        hooks = self.hooks = []
+
+        class Counter(RiakObject):
+            bucket_name = 'counters25'
+            write_behind = buf
+
+            name = String(required=True)
+            count = Integer()
+
+            def pre_save(self):
+                hooks.append('pre_save')
+
+            def post_save(self):
+                hooks.append('post_save')
+
+        return Counter
+
+    def _stored(self, key):
+        return self.client.bucket('counters25').get(key)
+
+    def test_saves_are_coalesced(self):
+        Counter = self._create_class()
+        counter = Counter(name='hits', count=0)
+        counter.save()
+        self.assertEquals(self.client.round_trips, 0)
+        for i in range(10):
+            counter.count += 1
+            counter.save()
+        self.assertEquals(len(Counter.write_behind), 1)
+        self.assertEquals(self.hooks, ['pre_save'] * 11)
+
+        result = Counter.write_behind.flush()
+        self.assertEquals(self.client.round_trips, 1)
+        self.assertTrue(result.ok)
+        self.assertEquals(self.hooks[-1], 'post_save')
+        self.assertEquals(self._stored(counter.key).data['count'], 10)
+
+        counter.count += 1
+        counter.save()
+        Counter.write_behind.flush()
+        self.assertEquals(self._stored(counter.key).data['count'], 11)
+
+    def test_validation_errors_are_raised_by_save(self):
+        Counter = self._create_class()
+        self.assertRaises(ValidationError, Counter(count=1).save)
+        self.assertEquals(len(Counter.write_behind), 0)
+
+    def test_flush_on_batch_size(self):
+        Counter = self._create_class(batch_size=2)
+        counters = [Counter(name='c%d' % (i,)) for i in range(2)]
+        for counter in counters:
+            counter.save()
+        self.assertTrue(_wait_for(lambda: all(counter.key is not None
+                                              for counter in counters)))
+        self.assertTrue(self._stored(counters[0].key).exists)
+
+    def test_flush_on_interval(self):
+        Counter = self._create_class(interval=0.05)
+        counter = Counter(name='hits')
+        counter.save()
+        self.assertTrue(_wait_for(lambda: counter.key is not None))
+
+    def test_backpressure(self):
+        Counter = self._create_class(max_pending=1, block_timeout=0.05)
+        counter = Counter(name='hits', count=1)
+        counter.save()
+        counter.count += 1
+        counter.save()
+        self.assertRaises(BufferFullError, Counter(name='misses').save)
+        Counter.write_behind.flush()
+        Counter(name='misses').save()
+
+    def test_delete_drops_queued_write(self):
+        Counter = self._create_class()
+        counter = Counter(name='hits', count=1)
+        counter.save()
+        counter.delete()
+        self.assertEquals(len(Counter.write_behind), 0)
+        Counter.write_behind.flush()
+        self.assertEquals(self.client.bucket('counters25').get_keys(), [])
+
+    def test_close_flushes(self):
+        Counter = self._create_class()
+        counter = Counter(name='hits')
+        counter.save()
+        self.assertTrue(Counter.write_behind.close().ok)
+        self.assertNotEquals(counter.key, None)
+
+    def test_changes_after_save_are_not_stored(self):
+        Counter = self._create_class()
+        counter = Counter(name='hits', count=0)
+        counter.save()
+        counter.count = 5
+        Counter.write_behind.flush()
+        self.assertEquals(self._stored(counter.key).data['count'], 0)
+        self.assertEquals(counter.changed_fields(), set(['count']))
+
+        counter.save()
+        counter.count = 6
+        Counter.write_behind.flush()
+        self.assertEquals(self._stored(counter.key).data['count'], 5)
+        counter.save()
+        Counter.write_behind.flush()
+        self.assertEquals(self._stored(counter.key).data['count'], 6)
+        self.assertEquals(counter.changed_fields(), set())
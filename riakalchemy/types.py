@@ -17,14 +17,24 @@
 
     The various data types RiakAlchemy understands
 """
+import sys
+
 from riakalchemy.exceptions import ValidationError
 
 
 class RiakType(object):
     link_type = False
-
-    def __init__(self, required=False):
+    # Suffix of the secondary index for types that can have one
+    index_suffix = None
+    # Whether values can be rebuilt from Riak Search documents
+    search_stored = False
+
+    def __init__(self, required=False, index=False):
+        if index and not self.index_suffix:
+            raise ValueError('%s fields cannot be indexed' %
+                             (self.__class__.__name__,))
         self.required = required
+        self.index = index
 
     def clean(self, value):
         return value
@@ -32,22 +42,57 @@ class RiakType(object):
     def validate(self, value):
         return True
 
+    def index_name(self, field):
+        return '%s%s' % (field, self.index_suffix)
+
+    def index_range(self, lookup, value):
+        """Translate a lookup (eq, gte, lte or range) into the start and
+        end values of a 2i query. End is None for exact matches."""
+        if lookup == 'eq':
+            return self.clean(value), None
+        elif lookup == 'gte':
+            return self.clean(value), self.index_max
+        elif lookup == 'lte':
+            return self.index_min, self.clean(value)
+        elif lookup == 'range':
+            start, end = value
+            return self.clean(start), self.clean(end)
+        raise ValidationError('Unsupported lookup for %s: %s' %
+                              (self.__class__.__name__, lookup))
+
 
 class Dict(RiakType):
     pass
 
 
 class String(RiakType):
-    pass
+    index_suffix = '_bin'
+    search_stored = True
+    index_min = u''
+    # The highest code point, which Riak sees as the highest UTF-8
+    # sequence
+    index_max = u'\U0010ffff'
 
 
 class Integer(RiakType):
+    index_suffix = '_int'
+    search_stored = True
+    index_min = -sys.maxint - 1
+    index_max = sys.maxint
+
     def clean(self, value):
         try:
             return int(value)
         except ValueError:
             raise ValidationError("%r could not be cast to integer" % (value,))
 
+    def index_range(self, lookup, value):
+        if lookup == 'gt':
+            return self.clean(value) + 1, self.index_max
+        elif lookup == 'lt':
+            return self.index_min, self.clean(value) - 1
+        return super(Integer, self).index_range(lookup, value)
+
 
 class RelatedObjects(RiakType):
     link_type = True
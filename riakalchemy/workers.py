@@ -0,0 +1,184 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Bounded worker pools for running Riak requests concurrently
+"""
+import threading
+import time
+
+from riakalchemy.exceptions import TimeoutError
+
+#: How many requests batch operations run at once, unless the model
+#: says otherwise
+default_concurrency = 8
+
+#: How many requests submitted through submit() run at once; the rest
+#: wait in line. Set through connect(async_pool_size=...)
+async_concurrency = 32
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(size, name='default'):
+    """Return the shared thread pool called `name` with `size` workers,
+    creating it on first use. Pools are kept around so that threads are
+    reused across calls. Work running in one pool must not wait for
+    work in the same pool, so give nested uses their own name."""
+    with _pools_lock:
+        if (name, size) not in _pools:
+            # multiprocessing is slow to import, so wait until it's needed
+            from multiprocessing.pool import ThreadPool
+            _pools[(name, size)] = ThreadPool(size)
+        return _pools[(name, size)]
+
+
+def map_ordered(func, items, concurrency):
+    """Call `func` on every item using at most `concurrency` workers.
+
+    Results are returned in the same order as `items`. The first
+    exception raised by `func` is re-raised."""
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    return get_pool(concurrency).map(func, items)
+
+
+class _Done(object):
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+    def ready(self):
+        return True
+
+
+def map_async(func, items, concurrency):
+    """Like map_ordered(), but returns immediately. The return value's
+    get() method waits for and returns the results."""
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return _Done([func(item) for item in items])
+    return get_pool(concurrency).map_async(func, items)
+
+
+def chunked(iterable, size):
+    """Split `iterable` into lists of at most `size` items."""
+    chunk = []
+    for item in iterable:
+        chunk += [item]
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def attempt(func, retries=0, delay=0):
+    """Call `func`, retrying up to `retries` times if it raises. The
+    delay between attempts starts at `delay` seconds and doubles every
+    time. Returns None on success, otherwise the last exception."""
+    while True:
+        try:
+            func()
+            return None
+        except Exception as e:
+            if retries <= 0:
+                return e
+        retries -= 1
+        time.sleep(delay)
+        delay *= 2
+
+
+class Future(object):
+    """The eventual result of a call made through submit().
+
+    Follows the concurrent.futures.Future interface. Callbacks added
+    with add_done_callback() run in the worker thread (or right away if
+    the future is already done); event loop users should hand the
+    result over with their loop's thread-safe scheduling call."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks += [callback]
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        """Raises TimeoutError if the call isn't done within `timeout`
+        seconds."""
+        if not self._done.wait(timeout):
+            raise TimeoutError('Timed out waiting for result')
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+def submit(func, *args, **kwargs):
+    """Run `func(*args, **kwargs)` on the shared pool of
+    `async_concurrency` threads and return a Future for its result."""
+    return submit_to(None, func, *args, **kwargs)
+
+
+def submit_to(concurrency, func, *args, **kwargs):
+    """Like submit(), but on a pool of `concurrency` threads (None for
+    `async_concurrency`)."""
+    future = Future()
+
+    def run():
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            future._finish(exception=e)
+        else:
+            future._finish(result)
+
+    get_pool(concurrency or async_concurrency, 'async').apply_async(run)
+    return future
+
+
+def shutdown():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.terminate()
+        _pools.clear()
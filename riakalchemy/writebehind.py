@@ -0,0 +1,203 @@
+"""
+    RiakAlchemy - Object Mapper for Riak
+
+    Copyright (C) 2011  Linux2Go
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License version 3 as
+    published by the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Write-behind buffering for save()
+
+    Set a WriteBehindBuffer as the `write_behind` attribute of a model
+    and save() no longer writes to Riak itself. It still runs
+    pre_save(), validates the object and encodes it, then queues a copy
+    of the result for a background thread to store. Changes made after
+    save() are left for the next save(). Saving an object again while it is
+    queued replaces the queued version, so an object updated many times
+    a second is written once per flush. post_save() runs after the
+    write, in the thread that did it.
+
+    Reads don't see queued writes; flush() first where that matters.
+    Buffers are closed, and so flushed, when the interpreter exits.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from riakalchemy.exceptions import BufferFullError
+from riakalchemy.instrumentation import instrumented
+from riakalchemy.model import BulkResult
+from riakalchemy import workers
+
+_buffers = []
+
+
+def _log_error(obj, error):
+    logging.getLogger('riakalchemy').error('Write-behind save of %r failed: '
+                                           '%s', obj, error)
+
+
+class WriteBehindBuffer(object):
+    """Queues saved objects and stores them `batch_size` at a time,
+    at least every `interval` seconds. Once `max_pending` objects are
+    waiting, save() blocks until there is room again, or raises
+    BufferFullError after `block_timeout` seconds.
+
+    Writes that still fail after `retries` retries are passed to
+    `on_error(obj, exception)`, which logs them by default."""
+
+    def __init__(self, batch_size=100, interval=1.0, max_pending=10000,
+                 block_timeout=None, concurrency=None, retries=2,
+                 retry_delay=0.1, on_error=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_error = on_error or _log_error
+        # (bucket name, key), or the id of objects without a key yet ->
+        # [object to store, its write snapshot, quorum, all instances
+        # saved under that key]
+        self._pending = {}
+        self._changed = threading.Condition(threading.Lock())
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        _buffers.append(self)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _ident(self, obj):
+        if obj.key is None:
+            return id(obj)
+        return (obj.bucket_name, obj.key)
+
+    def add(self, obj, snapshot, quorum=None):
+        """Queue `snapshot` (from obj._write_snapshot()) to be stored."""
+        ident = self._ident(obj)
+        with self._changed:
+            if ident not in self._pending:
+                self._wait_for_room(ident)
+            entry = self._pending.setdefault(ident, [obj, snapshot, quorum,
+                                                     []])
+            entry[:3] = [obj, snapshot, quorum]
+            if not any(instance is obj for instance in entry[3]):
+                entry[3] += [obj]
+            if len(self._pending) >= self.batch_size:
+                self._changed.notify_all()
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _wait_for_room(self, ident):
+        if self.block_timeout is not None:
+            deadline = time.time() + self.block_timeout
+        while (len(self._pending) >= self.max_pending and
+               ident not in self._pending):
+            if self.block_timeout is None:
+                self._changed.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise BufferFullError('%d objects waiting to be stored' %
+                                      (len(self._pending),))
+            self._changed.wait(remaining)
+
+    def discard(self, obj):
+        """Forget the queued write of `obj`, if any (e.g. because it is
+        being deleted)."""
+        with self._changed:
+            entry = self._pending.get(self._ident(obj))
+            if entry is not None and any(instance is obj
+                                         for instance in entry[3]):
+                del self._pending[self._ident(obj)]
+                self._changed.notify_all()
+
+    @instrumented('flush')
+    def flush(self):
+        """Store everything queued so far. Returns a BulkResult."""
+        with self._flush_lock:
+            with self._changed:
+                entries = self._pending.values()
+                self._pending = {}
+                self._changed.notify_all()
+
+            def store(entry):
+                obj, snapshot, quorum, instances = entry
+                return workers.attempt(
+                    lambda: obj._store_snapshot(snapshot, quorum),
+                    self.retries, self.retry_delay)
+
+            errors = workers.map_ordered(store, entries,
+                                         self.concurrency or
+                                         workers.default_concurrency)
+            result = BulkResult()
+            for (obj, snapshot, quorum, instances), error in zip(entries,
+                                                                 errors):
+                for instance in instances:
+                    if error is None:
+                        try:
+                            instance.post_save()
+                        except Exception as e:
+                            result.failed += [(instance, e)]
+                        else:
+                            result.succeeded += [instance]
+                    else:
+                        result.failed += [(instance, error)]
+            return result
+
+    def close(self):
+        """Stop the background thread and flush. Objects saved
+        afterwards are queued until the next flush()."""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        return self.flush()
+
+    def _run(self):
+        while True:
+            deadline = time.time() + self.interval
+            with self._changed:
+                while (len(self._pending) < self.batch_size and
+                       not self._closed):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                if self._closed:
+                    return
+                if not self._pending:
+                    continue
+            try:
+                result = self.flush()
+            except Exception:
+                logging.getLogger('riakalchemy').exception(
+                    'Write-behind flush failed')
+                continue
+            for obj, error in result.failed:
+                self.on_error(obj, error)
+
+
+@atexit.register
+def close_all():
+    """Close every buffer. Runs when the interpreter exits, so queued
+    writes aren't lost."""
+    for buf in _buffers:
+        for obj, error in buf.close().failed:
+            buf.on_error(obj, error)